@@ -12,12 +12,43 @@ Organizes extracted information into:
 import json
 import argparse
 import os
+import re
+import sys
+import logging
+import atexit
 from pathlib import Path
-from typing import List, Callable, Any, get_origin, get_args, Union
-from docx import Document
-from openai import OpenAI
+from typing import List, Dict, Optional, Callable, Any, Iterable, Iterator, get_origin, get_args, Union
+from openai import OpenAI, APITimeoutError, APIConnectionError, RateLimitError, InternalServerError
 import inspect
 import datetime
+import threading
+import time
+import zipfile
+import functools
+import hashlib
+import io
+import contextvars
+import contextlib
+import bisect
+import sqlite3
+import heapq
+import random
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lxml import etree
+import msgspec
+
+# httpx (installed with openai) lets the shared client size its connection pool;
+# HTTP/2 is used when the optional h2 package is installed
+try:
+    import httpx
+    from openai import DefaultHttpxClient
+except ImportError:
+    httpx = None
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
 
 # Load environment variables from .env file if it exists
 _ENV_LOADED = False
@@ -46,66 +77,350 @@ COMPANY_INDUSTRIES = os.getenv("COMPANY_INDUSTRIES", "")
 
 print(f"[DEBUG] After loading - API key present: {bool(MOONSHOT_API_KEY)}")
 
-# Model selection (Kimi models - based on official API documentation)
-MODEL_FAST = "kimi-k2.5"      # Kimi K2.5 model for fast extraction
-MODEL_SMART = "kimi-k2.5"     # Kimi K2.5 model for complex analysis
+# Progress output of the extractors and retrieval tools. Written to stdout synchronously,
+# so it stays in order with the [Tag] progress lines the rest of the script prints
+log = logging.getLogger("knowledge_base_builder")
+log.setLevel(logging.INFO)
+log.propagate = False
+log.addHandler(logging.StreamHandler(sys.stdout))
+
+# Output of the document being processed, while it is buffered (see buffer_document_output).
+# Executor tasks started for the document share it through contextvars.copy_context().
+_document_output: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar("document_output", default=None)
+
+
+class _DocumentOutputStream(io.TextIOBase):
+    """sys.stdout wrapper sending what is printed while a document is buffered to its buffer"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        buffer = _document_output.get()
+        if buffer is None:
+            return self.stream.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def _buffer_log_record(record: logging.LogRecord) -> bool:
+    """Logger filter moving a buffered document's messages below WARNING into its buffer"""
+    buffer = _document_output.get()
+    if buffer is None or record.levelno >= logging.WARNING:
+        return True
+    buffer.append(record.getMessage() + "\n")
+    return False
+
 
-# Global variable to store current document data for retrieval functions
-_current_document_data = None
+log.addFilter(_buffer_log_record)
 
 
-def _is_optional(annotation) -> bool:
+@contextlib.contextmanager
+def capture_document_output():
+    """Route sys.stdout through _DocumentOutputStream until the block exits, then restore it
+
+    Wrap the worker pool in this so buffer_document_output can hold back what
+    each document prints; output from outside a buffered document passes straight through.
     """
-    Check if a type annotation is Optional (Union with None).
+    original = sys.stdout
+    sys.stdout = _DocumentOutputStream(original)
+    try:
+        yield
+    finally:
+        sys.stdout = original
 
-    Args:
-        annotation: The type annotation to check
 
-    Returns:
-        True if the annotation is Optional[T] (i.e., Union[T, None])
+@contextlib.contextmanager
+def buffer_document_output():
+    """Hold back everything a document prints and logs, then write it to stdout at once
+
+    Used when documents run in parallel, so each one's output comes out as one
+    block with a single write instead of interleaving line by line with the
+    others. Warnings and errors are still shown as they happen. Prints are only
+    held back inside capture_document_output().
     """
-    if annotation == inspect.Parameter.empty:
-        return False
+    stream = sys.stdout.stream if isinstance(sys.stdout, _DocumentOutputStream) else sys.stdout
+    buffer = []
+    token = _document_output.set(buffer)
+    try:
+        yield
+    finally:
+        _document_output.reset(token)
+        stream.write("".join(buffer))
+        stream.flush()
 
-    # Get the origin type (e.g., Union from Union[str, None])
-    origin = get_origin(annotation)
+# Model selection (Kimi models - based on official API documentation)
+MODEL_FAST = os.getenv("KIMI_MODEL_FAST", "kimi-k2.5")     # Model for fast extraction
+MODEL_SMART = os.getenv("KIMI_MODEL_SMART", "kimi-k2.5")   # Model for complex analysis
+MODEL_BEST = os.getenv("KIMI_MODEL_BEST", MODEL_SMART)     # Model for the "high" quality tier
+MODEL_TINY = os.getenv("KIMI_MODEL_TINY", MODEL_FAST)      # Model for short schema-bound JSON (metadata, client info)
+
+# Quality tiers (--quality): models for the light (metadata, client) and heavy
+# (product knowledge, reference materials) extractors, and the model heavy
+# extractions escalate to when they fail or come back too short
+QUALITY_TIERS = {
+    "fast": {"light": MODEL_TINY, "heavy": MODEL_FAST, "escalate": MODEL_SMART},
+    "balanced": {"light": MODEL_TINY, "heavy": MODEL_SMART, "escalate": None},
+    "high": {"light": MODEL_SMART, "heavy": MODEL_BEST, "escalate": None},
+}
+ACTIVE_MODELS = dict(QUALITY_TIERS["balanced"])
+
+# Knowledge shorter than this (and not INSUFFICIENT_INFORMATION) triggers escalation
+MIN_KNOWLEDGE_CHARS = 200
+
+# A product with fewer mentions than this and no heading of its own is only mentioned
+# in passing; its article is INSUFFICIENT_INFORMATION without asking the model
+MIN_PRODUCT_MENTIONS = 3
+
+# WordprocessingML element names and XPath helpers for reading document.xml directly
+_W_NAMESPACES = {"w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main"}
+_W_BODY = "{%s}body" % _W_NAMESPACES["w"]
+_W_P = "{%s}p" % _W_NAMESPACES["w"]
+_W_TBL = "{%s}tbl" % _W_NAMESPACES["w"]
+_W_TR = "{%s}tr" % _W_NAMESPACES["w"]
+_W_TC = "{%s}tc" % _W_NAMESPACES["w"]
+_W_T = "{%s}t" % _W_NAMESPACES["w"]
+_W_BR = "{%s}br" % _W_NAMESPACES["w"]
+_W_TYPE = "{%s}type" % _W_NAMESPACES["w"]
+_W_VAL = "{%s}val" % _W_NAMESPACES["w"]
+_W_STYLE_ID = "{%s}styleId" % _W_NAMESPACES["w"]
+# Text of the run elements other than w:t and w:br, as python-docx's Run.text reads them
+_W_RUN_CHARS = {
+    "{%s}tab" % _W_NAMESPACES["w"]: "\t",
+    "{%s}ptab" % _W_NAMESPACES["w"]: "\t",
+    "{%s}cr" % _W_NAMESPACES["w"]: "\n",
+    "{%s}noBreakHyphen" % _W_NAMESPACES["w"]: "-",
+}
+_xpath_runs = etree.XPath("w:r | w:hyperlink/w:r", namespaces=_W_NAMESPACES)
+_xpath_style = etree.XPath("w:pPr/w:pStyle/@w:val", namespaces=_W_NAMESPACES)
+
+# Built-in style names as stored in styles.xml, mapped to the names Word displays
+_BUILTIN_STYLE_NAMES = {
+    "caption": "Caption",
+    "footer": "Footer",
+    "header": "Header",
+    **{f"heading {level}": f"Heading {level}" for level in range(1, 10)},
+}
+
+# Section levels for heading styles; other styles containing "Heading" are level 5
+_HEADING_LEVELS = {"Heading 1": 1, "Heading 2": 2, "Heading 3": 3, "Heading 4": 4}
+
+# Content digest passed to the content-based extractors (see skim_document)
+SKIM_CHARS = 10000            # Maximum digest size in characters
+SKIM_MIN_LINE_CHARS = 20      # Shorter body lines (page numbers, captions, etc.) are dropped
+
+# Content sent to the client pass. In group mode the digests of all a client's
+# documents share it (see share_budget), so every document is represented
+CLIENT_CONTENT_CHARS = 20000
+
+# Metadata sample (see build_metadata_sample): headings, the start of each section
+# and lines naming systems/clients, instead of a blind prefix of the document
+METADATA_SAMPLE_CHARS = 4000
+METADATA_SECTION_CHARS = 300
+# Lines that name something (a capitalized word) next to a metadata keyword
+_METADATA_KEYWORD_RE = re.compile(
+    r'\b(?:system|platform|software|product|application|client|customer|site|project|company)s?\b', re.I)
+_PROPER_NAME_RE = re.compile(r'\b[A-Z][A-Za-z0-9]+(?:\s+[A-Z][A-Za-z0-9]+)*\b')
+
+# Signs that a document names products or clients at all (see has_likely_entities):
+# an acronym such as "QMS" (other than our own [TABLE] markers), or several
+# capitalized multi-word phrases such as "Insight CM" or "Roy Hill"
+_ACRONYM_RE = re.compile(r'\b(?!TABLE\b)[A-Z][A-Z0-9]+\b')
+_NAME_PHRASE_RE = re.compile(r'\b[A-Z][A-Za-z]+(?:[ \t]+[A-Z][A-Za-z]+)+\b')
+MIN_NAME_PHRASES = 3
+
+# Known products spotted without the model (see spot_known_products): a product counts as
+# substantially discussed with LEXICON_MIN_HITS mentions, or a mention next to a technical keyword
+LEXICON_MIN_HITS = 3
+_TECHNICAL_KEYWORD_RE = re.compile(r'\b(?:configur\w*|install\w*|architecture|set ?up|integrat\w*)\b', re.I)
+
+# Standard client information categories, saved in this order before any others
+CLIENT_CATEGORIES = ("overview", "locations", "hardware", "configuration", "contacts")
+_CLIENT_CATEGORY_SET = frozenset(CLIENT_CATEGORIES)
+
+
+class _FilenameTable(dict):
+    """str.translate table for reference material filenames
+
+    Word characters and '-' map to themselves, anything else (spaces included) to '_'.
+    Each character's mapping is worked out on first use and kept.
+    """
 
-    # Check if it's a Union type
-    if origin is Union:
-        # Get the types in the Union
-        args = get_args(annotation)
-        # Check if None is one of the types
-        return type(None) in args
+    def __missing__(self, codepoint: int) -> int:
+        char = chr(codepoint)
+        self[codepoint] = mapped = codepoint if char.isalnum() or char in "-_" else ord("_")
+        return mapped
 
-    return False
 
+_FILENAME_TABLE = _FilenameTable()
 
-def _get_type_schema(annotation) -> dict:
+# source_document_modified value in an existing article's YAML front matter
+_SOURCE_MODIFIED_RE = re.compile(r'source_document_modified:\s*"?([^"\n]+)"?')
+
+# Bytes read from the start of an existing article to find its YAML front matter
+FRONT_MATTER_READ_BYTES = 2048
+
+# Maximum number of concurrent Moonshot API requests (respects account rate limits)
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MOONSHOT_MAX_CONCURRENCY", "8"))
+_request_semaphore = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+
+# Seconds an idle pooled API connection is kept open. Long enough to outlast the
+# confirmation prompt after the connection test and the gaps between documents.
+HTTP_KEEPALIVE_EXPIRY = 300
+
+# Retries for transient API failures (timeouts, dropped connections, rate limits, 5xx errors)
+# and invalid JSON responses. A request keeps retrying until API_RETRY_BUDGET seconds have
+# passed since its first attempt; the delay doubles after each failure, with jitter so
+# concurrent workers don't retry in lockstep.
+API_RETRY_BUDGET = float(os.getenv("KB_RETRY_BUDGET", "300"))
+API_RETRY_BASE_DELAY = 1      # Seconds
+API_RETRY_MAX_DELAY = 20
+JSON_ATTEMPTS = 3             # Initial response plus correction re-prompts
+
+# Upper bound in seconds for a single API request; a stalled call times out and is
+# retried instead of holding up the run. Callers' own timeouts apply when lower.
+LLM_REQUEST_TIMEOUT = float(os.getenv("KB_LLM_TIMEOUT", "90"))
+
+# Output token cap for the metadata pass, whose answer is a few short fields;
+# leaves room for the model's reasoning while stopping runaway responses
+METADATA_MAX_TOKENS = 2048
+# Same for the fused metadata and client call, whose client details (contacts,
+# hardware, configuration notes) can run much longer than the metadata fields
+METADATA_AND_CLIENT_MAX_TOKENS = 8192
+
+# Seconds between status checks while a --batch-mode metadata batch is processed
+BATCH_POLL_INTERVAL = 30
+_RETRYABLE_ERRORS = (TimeoutError, APITimeoutError, APIConnectionError, RateLimitError, InternalServerError)
+_retry_stats = {"api": 0, "json": 0}
+_retry_stats_lock = threading.Lock()
+
+# Optional on-disk cache of final model responses, keyed by a SHA-256 of the request.
+# Set KB_CACHE_DIR to enable; bump PROMPT_VERSION to invalidate entries after prompt changes.
+LLM_CACHE_DIR = os.getenv("KB_CACHE_DIR")
+PROMPT_VERSION = "2"
+# Bump when extract_document_structure's output changes, so parsed documents
+# cached under KB_CACHE_DIR/documents are parsed again
+DOCUMENT_CACHE_VERSION = "2"
+# Product articles are reused for near-duplicate documents: documents whose word
+# shingles overlap by at least NEAR_DUPLICATE_THRESHOLD (Jaccard similarity,
+# estimated from bottom-k sketches of NEAR_DUPLICATE_SKETCH shingle hashes)
+NEAR_DUPLICATE_THRESHOLD = 0.97
+NEAR_DUPLICATE_SKETCH = 128
+NEAR_DUPLICATE_SHINGLE_WORDS = 5
+# Newest articles kept per product and model; lookups compare against all of them
+NEAR_DUPLICATE_MAX_ENTRIES = 200
+
+# Current document data used by retrieval functions. Each thread (and each copied
+# context) sees its own value, so extractions for different products can run concurrently
+_current_document: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("current_document", default=None)
+
+
+def _get_current_document() -> Optional[dict]:
+    """Return the document data loaded for the current context, or None"""
+    return _current_document.get()
+
+
+# Per-product/per-client locks so parallel documents don't overwrite each other's files
+_save_locks = {}
+_save_locks_guard = threading.Lock()
+
+
+def _get_save_lock(kind: str, name: str) -> threading.Lock:
+    """Return the lock serializing writes to one product or client directory"""
+    with _save_locks_guard:
+        return _save_locks.setdefault((kind, name), threading.Lock())
+
+
+# ============================================================================
+# Extraction Result Types (decoded and validated with msgspec)
+# ============================================================================
+
+class DocumentMetadata(msgspec.Struct):
+    """Products, client, type and category identified in a document"""
+    products: List[str]
+    client_name: Optional[str]
+    document_type: str
+    document_category: str
+
+
+class DocumentClassification(msgspec.Struct):
+    """Client, type and category of a document whose products are already known"""
+    client_name: Optional[str]
+    document_type: str
+    document_category: str
+
+
+class ReferenceMaterial(msgspec.Struct):
+    """A reusable knowledge item (guide, template, procedure, etc.) extracted from a document"""
+    type: str
+    title: str
+    category: str
+    content: str
+    tags: List[str] = []
+
+
+class ProductExtraction(msgspec.Struct):
+    """Wiki article and reference materials for one product"""
+    knowledge: str
+    reference_materials: List[ReferenceMaterial] = []
+
+
+# Client information: category name -> overview text or list of details.
+# A plain mapping because the model may add categories beyond the standard ones.
+# Empty categories may come back as null; drop_empty_categories() removes them.
+ClientInfo = Dict[str, Optional[Union[str, List[str]]]]
+
+
+def drop_empty_categories(client_data: ClientInfo) -> ClientInfo:
+    """Return the client categories the model filled in, without the null ones"""
+    return {key: value for key, value in client_data.items() if value is not None}
+
+
+class MetadataAndClient(msgspec.Struct):
+    """What extract_metadata_and_client() pulls out of a document in one call"""
+    metadata: DocumentMetadata
+    client: Optional[ClientInfo] = None
+
+
+class CombinedExtraction(msgspec.Struct):
+    """Everything extract_all() pulls out of a document in one call"""
+    metadata: DocumentMetadata
+    products: Dict[str, ProductExtraction] = {}
+    client: Optional[ClientInfo] = None
+
+
+# JSON schemas for plain parameter annotations; an unannotated parameter is a string
+_PRIMITIVE_SCHEMA = {
+    inspect.Parameter.empty: {"type": "string"},
+    int: {"type": "integer"},
+    float: {"type": "number"},
+    bool: {"type": "boolean"},
+    str: {"type": "string"},
+    dict: {"type": "object"},
+    list: {"type": "array"},
+}
+
+
+def _analyze_annotation(annotation) -> tuple:
     """
-    Convert a Python type annotation to OpenAI function parameter schema.
+    Convert a Python type annotation to an OpenAI function parameter schema,
+    noting whether it is Optional (a Union with None).
 
     Args:
         annotation: The type annotation from inspect.signature
 
     Returns:
-        Dict with 'type' and optionally 'items' for arrays
+        Tuple of (schema dict with 'type' and optionally 'items' for arrays, is_optional)
     """
-    if annotation == inspect.Parameter.empty:
-        return {"type": "string"}
-
-    # Handle basic types
-    if annotation == int:
-        return {"type": "integer"}
-    elif annotation == float:
-        return {"type": "number"}
-    elif annotation == bool:
-        return {"type": "boolean"}
-    elif annotation == str:
-        return {"type": "string"}
-    elif annotation == dict:
-        return {"type": "object"}
-    elif annotation == list:
-        return {"type": "array"}
+    schema = _PRIMITIVE_SCHEMA.get(annotation)
+    if schema is not None:
+        return dict(schema), False
 
     # Handle typing module types
     origin = get_origin(annotation)
@@ -114,107 +429,106 @@ def _get_type_schema(annotation) -> dict:
     # Handle List[T]
     if origin is list:
         if args:
-            # Get the inner type
-            inner_type = _get_type_schema(args[0])
-            return {
-                "type": "array",
-                "items": inner_type
-            }
-        return {"type": "array"}
+            return {"type": "array", "items": _get_type_schema(args[0])}, False
+        return {"type": "array"}, False
 
     # Handle Union types (including Optional)
     if origin is Union:
         # Filter out None from the union
-        non_none_types = [arg for arg in args if arg != type(None)]
-
-        if len(non_none_types) == 1:
-            # This is Optional[T], return schema for T
-            return _get_type_schema(non_none_types[0])
-        else:
-            # Multiple non-None types - can't represent in JSON schema easily
-            # Default to the first type
-            return _get_type_schema(non_none_types[0])
+        non_none_types = [arg for arg in args if arg is not type(None)]
+        # Optional[T] gives the schema for T; with several non-None types
+        # (not easily represented in JSON schema) default to the first
+        return _get_type_schema(non_none_types[0]), len(non_none_types) < len(args)
 
     # Default to string for unknown types
-    return {"type": "string"}
+    return {"type": "string"}, False
+
+
+def _get_type_schema(annotation) -> dict:
+    """Convert a Python type annotation to OpenAI function parameter schema"""
+    return _analyze_annotation(annotation)[0]
+
+
+# Fast JSON decode/encode (msgspec) for model responses, tool arguments and tool results.
+# Encoded output is UTF-8 rather than ASCII-escaped, which also keeps tool results shorter.
+_loads = msgspec.json.decode
+_encoder = msgspec.json.Encoder()
+
 
+def _dumps(obj: Any) -> str:
+    """Encode an object as a JSON string"""
+    return _encoder.encode(obj).decode("utf-8")
 
-def parse_json_response(content: str) -> Any:
+
+@functools.lru_cache(maxsize=None)
+def _json_decoder(result_type: Any) -> msgspec.json.Decoder:
+    """Decoder for a result type, reused so its validation is only set up once"""
+    return msgspec.json.Decoder(result_type)
+
+
+# JSON in model responses: the body of a ```json (or bare ```) fence, and the first { or [
+_JSON_FENCE_RE = re.compile(r'```(?:json)?[ \t]*(?:\n|(?=[\{\[]))(.*?)(?:```|\Z)', re.S)
+_JSON_START_RE = re.compile(r'[\{\[]')
+
+
+def parse_json_response(content: str, result_type: Any = None) -> Any:
     """
     Parse JSON from AI response, handling markdown code blocks.
 
     Args:
         content: The raw response content that may contain JSON wrapped in markdown
+        result_type: Optional type (e.g. a msgspec.Struct) to decode and validate into
 
     Returns:
-        Parsed JSON as dict, list, or other JSON-compatible type
+        Parsed JSON as dict, list, or other JSON-compatible type, or an instance
+        of result_type if given
 
     Raises:
-        json.JSONDecodeError: If the content is not valid JSON
+        json.JSONDecodeError: If the content is empty or no JSON is found
+        msgspec.DecodeError: If the JSON is malformed
+        msgspec.ValidationError: If the JSON doesn't match result_type
     """
     if not content:
         raise json.JSONDecodeError("Empty content", "", 0)
 
-    # Strip whitespace
-    cleaned = content.strip()
+    # Take the body of a ```/```json code fence if there is one (closing fence optional).
+    # Bare JSON is used as is, so fences inside its string values are never matched.
+    candidate = content.lstrip()
+    if candidate[:1] not in ('{', '['):
+        fence = _JSON_FENCE_RE.search(candidate)
+        if fence:
+            candidate = fence.group(1)
 
-    # Look for markdown code fence with json language identifier
-    if '```json' in cleaned:
-        # Extract content between ```json and closing ```
-        start = cleaned.find('```json') + 7  # len('```json')
-        end = cleaned.find('```', start)
-        if end != -1:
-            cleaned = cleaned[start:end].strip()
-        else:
-            # No closing fence, take everything after ```json
-            cleaned = cleaned[start:].strip()
-    # Look for generic markdown code fence at start
-    elif cleaned.startswith('```'):
-        # Remove opening fence
-        cleaned = cleaned.split('\n', 1)[1] if '\n' in cleaned else cleaned[3:]
-        if cleaned.endswith('```'):
-            # Remove closing fence
-            cleaned = cleaned.rsplit('\n', 1)[0] if '\n' in cleaned else cleaned[:-3]
-        cleaned = cleaned.strip()
-
-    # If still has explanatory text before JSON, find JSON start
-    if cleaned and cleaned[0] not in ('{', '['):
-        # Find first { or [ which indicates JSON start
-        json_start = -1
-        for char in ('{', '['):
-            pos = cleaned.find(char)
-            if pos != -1 and (json_start == -1 or pos < json_start):
-                json_start = pos
-
-        if json_start != -1:
-            cleaned = cleaned[json_start:]
-        else:
-            # No JSON found
-            raise json.JSONDecodeError(f"No JSON found in response. Content starts with: {cleaned[:100]}", "", 0)
+    # Skip any explanatory text before the JSON
+    json_start = _JSON_START_RE.search(candidate)
+    if not json_start:
+        raise json.JSONDecodeError(f"No JSON found in response. Content starts with: {candidate.strip()[:100]}", "", 0)
+    cleaned = candidate[json_start.start():].rstrip()
+
+    if result_type is not None:
+        return _json_decoder(result_type).decode(cleaned)
+    return _loads(cleaned)
 
-    return json.loads(cleaned)
 
+# Google-style docstring parts used to describe tools: the summary before Args:/Returns:,
+# the indented Args: block, and "name (type): description" lines within it
+_DOC_DESCRIPTION_RE = re.compile(r'(.*?)(?=^(?:Args|Returns):|\Z)', re.M | re.S)
+_DOC_ARGS_RE = re.compile(r'^Args:[ \t]*\n(.*?)(?=^\S|\Z)', re.M | re.S)
+_DOC_ARG_RE = re.compile(r'^[ \t]+(\w+)[ \t]*(?:\([^)]*\))?[ \t]*:[ \t]*(.*?)[ \t]*$', re.M)
 
+
+@functools.lru_cache(maxsize=None)
 def function_to_tool_schema(func: Callable) -> dict:
-    """Convert a Python function with type hints and docstring to OpenAI tool schema"""
+    """Convert a Python function with type hints and docstring to OpenAI tool schema
+
+    Cached per function, so the returned schema is shared and must not be modified.
+    """
     sig = inspect.signature(func)
     doc = inspect.getdoc(func) or ""
     
     # Parse docstring for parameter descriptions
-    param_descriptions = {}
-    lines = doc.split('\n')
-    in_args_section = False
-    for line in lines:
-        line = line.strip()
-        if line.startswith('Args:'):
-            in_args_section = True
-            continue
-        if in_args_section and ':' in line:
-            param_name = line.split(':')[0].strip()
-            param_desc = ':'.join(line.split(':')[1:]).strip()
-            param_descriptions[param_name] = param_desc
-        elif in_args_section and line and not line[0].isspace():
-            in_args_section = False
+    args_section = _DOC_ARGS_RE.search(doc)
+    param_descriptions = dict(_DOC_ARG_RE.findall(args_section.group(1))) if args_section else {}
     
     # Build parameters schema
     properties = {}
@@ -224,23 +538,17 @@ def function_to_tool_schema(func: Callable) -> dict:
         if param_name == 'self':
             continue
 
-        param_schema = _get_type_schema(param.annotation)
+        param_schema, optional = _analyze_annotation(param.annotation)
         param_schema["description"] = param_descriptions.get(param_name, f"The {param_name} parameter")
 
         properties[param_name] = param_schema
 
         # Check if parameter is required (no default value and not Optional)
-        if param.default == inspect.Parameter.empty and not _is_optional(param.annotation):
+        if param.default == inspect.Parameter.empty and not optional:
             required.append(param_name)
     
     # Get function description from docstring
-    description_lines = []
-    for line in lines:
-        if line.startswith('Args:') or line.startswith('Returns:'):
-            break
-        if line:
-            description_lines.append(line)
-    description = ' '.join(description_lines) or func.__name__
+    description = ' '.join(_DOC_DESCRIPTION_RE.match(doc).group(1).split()) or func.__name__
     
     return {
         "type": "function",
@@ -256,13 +564,258 @@ def function_to_tool_schema(func: Callable) -> dict:
     }
 
 
+def _count_retry(kind: str):
+    """Record a retry in the run summary"""
+    with _retry_stats_lock:
+        _retry_stats[kind] += 1
+
+
+def create_completion(client: OpenAI, completion_args: dict) -> Any:
+    """Call the chat completions API, retrying transient failures with exponential backoff
+
+    Args:
+        client: OpenAI client
+        completion_args: Arguments for client.chat.completions.create
+
+    Returns:
+        The API response
+
+    Raises:
+        The last error once the next retry would end after API_RETRY_BUDGET seconds
+    """
+    deadline = time.monotonic() + API_RETRY_BUDGET
+    delay = API_RETRY_BASE_DELAY
+    attempt = 1
+    while True:
+        try:
+            with _request_semaphore:
+                return client.chat.completions.create(**completion_args)
+        except _RETRYABLE_ERRORS as e:
+            wait = random.uniform(delay / 2, delay)
+            if time.monotonic() + wait >= deadline:
+                raise
+            _count_retry("api")
+            attempt += 1
+            log.warning("      [RETRY] %s, retrying in %.1fs (attempt %d)", type(e).__name__, wait, attempt)
+            time.sleep(wait)
+            delay = min(delay * 2, API_RETRY_MAX_DELAY)
+
+
+def print_retry_summary():
+    """Print how many API calls and JSON responses had to be retried"""
+    with _retry_stats_lock:
+        print(f"[Retries] API: {_retry_stats['api']}, invalid JSON: {_retry_stats['json']}")
+
+
+def _llm_cache_key(model: str, prompt: str, functions: Optional[List[Callable]], response_format: Optional[dict]) -> str:
+    """Build the response cache key for a request
+
+    Tool-calling requests also include the current document's fingerprint,
+    since the tools answer from that document.
+    """
+    parts = [model, prompt, ",".join(sorted(func.__name__ for func in functions or [])),
+             json.dumps(response_format, sort_keys=True), PROMPT_VERSION]
+    if functions:
+        document_data = _get_current_document()
+        parts.append(document_data.get("fingerprint", "") if document_data else "")
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+class SqliteLLMCache:
+    """Exact-match response cache in a single SQLite file
+
+    One connection is shared by all worker threads and serialized with a lock;
+    WAL journaling keeps lookups from waiting on writes by other processes.
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, content TEXT NOT NULL, model TEXT, ts REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS near_duplicates "
+            "(scope TEXT NOT NULL, sketch TEXT NOT NULL, content TEXT NOT NULL, ts REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS near_duplicates_scope ON near_duplicates (scope)")
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached content for a key, or None"""
+        with self._lock:
+            row = self._conn.execute("SELECT content FROM responses WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, content: str, model: str = None):
+        """Store content under a key, replacing any previous entry"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, model, ts) VALUES (?, ?, ?, ?)",
+                (key, content, model, time.time())
+            )
+
+    def get_similar(self, scope: str, sketch: List[int], threshold: float) -> Optional[str]:
+        """Return the content stored in scope for the most similar sketch, if similar enough
+
+        Only the sketches are read to find the best match; the content is then
+        fetched for that one row.
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT rowid, sketch FROM near_duplicates WHERE scope = ?", (scope,)).fetchall()
+        best_similarity, best_rowid = 0.0, None
+        for rowid, stored_sketch in rows:
+            similarity = _sketch_similarity(sketch, _loads(stored_sketch))
+            if similarity > best_similarity:
+                best_similarity, best_rowid = similarity, rowid
+        if best_similarity < threshold:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT content FROM near_duplicates WHERE rowid = ?", (best_rowid,)).fetchone()
+        return row[0] if row else None
+
+    def set_similar(self, scope: str, sketch: List[int], content: str):
+        """Store content in scope under a document sketch, keeping the newest NEAR_DUPLICATE_MAX_ENTRIES"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO near_duplicates (scope, sketch, content, ts) VALUES (?, ?, ?, ?)",
+                (scope, _dumps(sketch), content, time.time())
+            )
+            self._conn.execute(
+                "DELETE FROM near_duplicates WHERE scope = ? AND rowid NOT IN "
+                "(SELECT rowid FROM near_duplicates WHERE scope = ? ORDER BY ts DESC, rowid DESC LIMIT ?)",
+                (scope, scope, NEAR_DUPLICATE_MAX_ENTRIES)
+            )
+
+
+def _document_sketch(doc_data: dict) -> List[int]:
+    """Bottom-k sketch of a document: the smallest hashes of its word shingles
+
+    Covers every heading and section body, so two sketches estimate how much
+    of the whole text two documents share.
+    """
+    soa = doc_data["_soa"]
+    words = " ".join(soa["headings"] + [content for content in soa["contents"] if content]).lower().split()
+    width = NEAR_DUPLICATE_SHINGLE_WORDS
+    hashes = {
+        int.from_bytes(hashlib.blake2b(" ".join(words[i:i + width]).encode("utf-8"), digest_size=8).digest(), "big")
+        for i in range(max(len(words) - width + 1, 1))
+    }
+    return heapq.nsmallest(NEAR_DUPLICATE_SKETCH, hashes)
+
+
+def _sketch_similarity(a: List[int], b: List[int]) -> float:
+    """Estimate the Jaccard similarity of two documents from their bottom-k sketches"""
+    union = heapq.nsmallest(NEAR_DUPLICATE_SKETCH, set(a) | set(b))
+    if not union:
+        return 0.0
+    common = set(a) & set(b)
+    return sum(1 for h in union if h in common) / len(union)
+
+
+def _product_sections_key(product_name: str, doc_data: dict, model: str) -> Optional[str]:
+    """Cache key for a product's knowledge, from the sections of a document that name it
+
+    Hashes each section whose heading or body mentions the product and sorts the
+    hashes, so any document repeating those sections (a templated or copied
+    document) gets the same key whatever else it contains.
+
+    Returns:
+        The key, or None if no section names the product
+    """
+    soa = doc_data["_soa"]
+    needle = product_name.lower()
+    section_hashes = sorted(
+        hashlib.sha256(f"{heading}\x00{content}".encode("utf-8")).hexdigest()
+        for heading, heading_lc, content in zip(soa["headings"], soa["headings_lc"], soa["contents"])
+        if needle in heading_lc or (content and needle in content.lower())
+    )
+    if not section_hashes:
+        return None
+    parts = ["product_sections", product_name, model, PROMPT_VERSION] + section_hashes
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_llm_cache() -> SqliteLLMCache:
+    """Return the shared response cache in KB_CACHE_DIR"""
+    return SqliteLLMCache(os.path.join(LLM_CACHE_DIR, "llm_cache.sqlite3"))
+
+
+def _llm_cache_get(key: str) -> Optional[str]:
+    """Return the cached response content for a key, or None"""
+    try:
+        return _get_llm_cache().get(key)
+    except sqlite3.Error as e:
+        print(f"      [CACHE] Response cache unavailable: {e}")
+        return None
+
+
+def _llm_cache_put(key: str, model: str, content: str):
+    """Store response content under a key"""
+    try:
+        _get_llm_cache().set(key, content, model)
+    except sqlite3.Error as e:
+        print(f"      [CACHE] Could not cache response: {e}")
+
+
+def _near_duplicate_get(scope: str, sketch: List[int]) -> Optional[str]:
+    """Return content cached in scope for a near-duplicate document, or None"""
+    try:
+        return _get_llm_cache().get_similar(scope, sketch, NEAR_DUPLICATE_THRESHOLD)
+    except sqlite3.Error as e:
+        print(f"      [CACHE] Response cache unavailable: {e}")
+        return None
+
+
+def _near_duplicate_put(scope: str, sketch: List[int], content: str):
+    """Store content in scope under a document sketch"""
+    try:
+        _get_llm_cache().set_similar(scope, sketch, content)
+    except sqlite3.Error as e:
+        print(f"      [CACHE] Could not cache response: {e}")
+
+
 def run_with_tools(client: OpenAI, model: str, prompt: str, functions: List[Callable] = None, 
-                   return_type: type = str, timeout: int = 300) -> Any:
+                   return_type: type = str, timeout: int = 300, response_format: dict = None,
+                   use_cache: bool = True, max_tokens: Optional[int] = None) -> Any:
     """
     Run a chat completion with optional function calling support.
     
     This mimics the Auggie SDK's agent.run() interface but uses OpenAI/Moonshot API.
+    Pass response_format={"type": "json_object"} to have the API enforce a JSON response,
+    and max_tokens to cap the length of each response.
+    When KB_CACHE_DIR is set (and use_cache is left on), final responses are
+    cached on disk and identical requests are answered from the cache.
     """
+    cache_key = None
+    content = None
+    if LLM_CACHE_DIR and use_cache:
+        cache_key = _llm_cache_key(model, prompt, functions, response_format)
+        content = _llm_cache_get(cache_key)
+        if content is not None:
+            print(f"      [CACHE] Reusing cached response ({cache_key[:12]})")
+
+    if content is None:
+        content = _run_tool_loop(client, model, prompt, functions, timeout, response_format, max_tokens)
+        if cache_key and content:
+            _llm_cache_put(cache_key, model, content)
+
+    # Try to parse as JSON if return_type is not str
+    if return_type != str and content:
+        try:
+            return parse_json_response(content)
+        except Exception:
+            return content
+    return content
+
+
+def _run_tool_loop(client: OpenAI, model: str, prompt: str, functions: Optional[List[Callable]],
+                   timeout: int, response_format: Optional[dict], max_tokens: Optional[int] = None) -> Optional[str]:
+    """Run the chat/tool-calling loop until the model stops, returning the final message content"""
     messages = [{"role": "user", "content": prompt}]
     
     # Convert functions to tool schemas
@@ -283,25 +836,25 @@ def run_with_tools(client: OpenAI, model: str, prompt: str, functions: List[Call
             "model": model,
             "messages": messages,
             "temperature": 1,  # Kimi K2.5 requires temperature=1
+            "timeout": min(timeout, LLM_REQUEST_TIMEOUT),
         }
         
         if tools:
             completion_args["tools"] = tools
             completion_args["tool_choice"] = "auto"
+
+        if response_format:
+            completion_args["response_format"] = response_format
+
+        if max_tokens:
+            completion_args["max_tokens"] = max_tokens
         
-        response = client.chat.completions.create(**completion_args)
+        response = create_completion(client, completion_args)
         choice = response.choices[0]
         
         # Check if we're done
         if choice.finish_reason == "stop":
-            content = choice.message.content
-            # Try to parse as JSON if return_type is not str
-            if return_type != str and content:
-                try:
-                    return parse_json_response(content)
-                except:
-                    return content
-            return content
+            return choice.message.content
         
         # Handle tool calls
         if choice.finish_reason == "tool_calls" and choice.message.tool_calls:
@@ -309,7 +862,7 @@ def run_with_tools(client: OpenAI, model: str, prompt: str, functions: List[Call
             
             for tool_call in choice.message.tool_calls:
                 function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
+                function_args = _loads(tool_call.function.arguments)
 
                 # Execute the function with error handling
                 if function_name in tool_map:
@@ -322,12 +875,18 @@ def run_with_tools(client: OpenAI, model: str, prompt: str, functions: List[Call
                         function_result = {"error": error_msg}
                         print(f"      [ERROR] Tool execution failed: {error_msg}")
 
-                    # Add function result to messages
+                    # Add function result to messages; the retrieval tools already return
+                    # text, which is sent as is, while dicts and lists are sent as JSON
+                    if not isinstance(function_result, str):
+                        if isinstance(function_result, (dict, list)):
+                            function_result = _dumps(function_result)
+                        else:
+                            function_result = str(function_result)
                     messages.append({
                         "role": "tool",
                         "tool_call_id": tool_call.id,
                         "name": function_name,
-                        "content": json.dumps(function_result) if isinstance(function_result, dict) else str(function_result)
+                        "content": function_result
                     })
                 else:
                     # Function not found in tool map
@@ -335,7 +894,7 @@ def run_with_tools(client: OpenAI, model: str, prompt: str, functions: List[Call
                         "role": "tool",
                         "tool_call_id": tool_call.id,
                         "name": function_name,
-                        "content": json.dumps({"error": f"Function {function_name} not found"})
+                        "content": _dumps({"error": f"Function {function_name} not found"})
                     })
         else:
             # Unexpected finish reason
@@ -345,10 +904,272 @@ def run_with_tools(client: OpenAI, model: str, prompt: str, functions: List[Call
     return choice.message.content if choice.message.content else ""
 
 
+# Re-prompt sent when a JSON extraction response fails to decode or validate
+_CORRECTION_PROMPT = """%(prompt)s
+
+            YOUR PREVIOUS RESPONSE WAS INVALID:
+            %(errors)s
+
+            PREVIOUS RESPONSE:
+            %(previous_response)s
+
+            Return the corrected JSON only.
+            """
+
+
+def run_json_extraction(client: OpenAI, model: str, prompt: str, result_type: Any, functions: List[Callable] = None,
+                        timeout: int = 120, json_mode: bool = True, max_tokens: Optional[int] = None) -> Any:
+    """
+    Run an extraction that must return JSON decoding to result_type.
+
+    Uses the API's JSON mode when json_mode is set (only valid for JSON object
+    responses), and caps each response at max_tokens if given. If the response
+    doesn't parse or validate, the model is asked to correct it, with the errors
+    and its previous response included, for up to JSON_ATTEMPTS attempts in total.
+
+    Returns:
+        The decoded and validated result (an instance of result_type)
+
+    Raises:
+        ValueError: If the response is still invalid after the correction attempts
+    """
+    response_format = {"type": "json_object"} if json_mode else None
+    current_prompt = prompt
+    errors = []
+
+    # Cache only validated responses, under the original prompt, so an invalid
+    # response is never replayed and a corrected one is reused on the next run
+    cache_key = None
+    if LLM_CACHE_DIR:
+        cache_key = _llm_cache_key(model, prompt, functions, response_format)
+        cached = _llm_cache_get(cache_key)
+        if cached is not None:
+            try:
+                parsed = parse_json_response(cached, result_type)
+                print(f"      [CACHE] Reusing cached response ({cache_key[:12]})")
+                return parsed
+            except (json.JSONDecodeError, msgspec.DecodeError):
+                pass
+
+    for attempt in range(1, JSON_ATTEMPTS + 1):
+        result = run_with_tools(
+            client=client,
+            model=model,
+            prompt=current_prompt,
+            functions=functions,
+            return_type=str,
+            timeout=timeout,
+            response_format=response_format,
+            use_cache=False,
+            max_tokens=max_tokens
+        )
+
+        try:
+            parsed = parse_json_response(result, result_type)
+            if cache_key:
+                _llm_cache_put(cache_key, model, result)
+            return parsed
+        except json.JSONDecodeError as e:
+            errors = [f"Invalid JSON: {e}"]
+        except msgspec.DecodeError as e:
+            errors = [str(e)]
+
+        if attempt == JSON_ATTEMPTS:
+            break
+
+        _count_retry("json")
+        print(f"      [RETRY] Invalid JSON response: {'; '.join(errors[:3])}")
+        current_prompt = _CORRECTION_PROMPT % {
+            "prompt": prompt,
+            "errors": "\n".join(errors[:10]),
+            "previous_response": (result or '')[:4000],
+        }
+
+    raise ValueError(f"Response did not match the expected schema: {'; '.join(errors[:3])}")
+
+
 # ============================================================================
 # Document Structure Extraction
 # ============================================================================
 
+@functools.lru_cache(maxsize=None)
+def _heading_level(style: str) -> Optional[int]:
+    """Return the section level for a paragraph style name, or None if it isn't a heading
+
+    Exact built-in names are a dict lookup; custom names such as "Custom Heading 2"
+    are matched by substring, as before. Cached, so each style is examined once.
+    """
+    level = _HEADING_LEVELS.get(style)
+    if level is not None:
+        return level
+    if 'Heading' not in style:
+        return None
+    for name, level in _HEADING_LEVELS.items():
+        if name in style:
+            return level
+    return 5
+
+
+def _read_style_names(docx_zip: zipfile.ZipFile) -> dict:
+    """Map paragraph style IDs to style names using word/styles.xml
+
+    Built-in heading names are stored lowercase ("heading 1"), so they are
+    translated to the names Word shows ("Heading 1").
+    """
+    try:
+        styles_root = etree.fromstring(docx_zip.read("word/styles.xml"))
+    except KeyError:
+        return {}
+
+    style_names = {}
+    for style in styles_root.iterfind("w:style", _W_NAMESPACES):
+        name = style.find("w:name", _W_NAMESPACES)
+        if name is None:
+            continue
+        name = name.get(_W_VAL)
+        style_names[style.get(_W_STYLE_ID)] = _BUILTIN_STYLE_NAMES.get(name, name)
+    return style_names
+
+
+def _read_core_properties(docx_zip: zipfile.ZipFile) -> dict:
+    """Read docProps/core.xml into a dict keyed by local element name (creator, modified, ...)"""
+    try:
+        core_root = etree.fromstring(docx_zip.read("docProps/core.xml"))
+    except KeyError:
+        return {}
+    return {etree.QName(prop).localname: (prop.text or "").strip() for prop in core_root}
+
+
+def _parse_w3cdtf(value: str) -> str:
+    """Convert a W3CDTF date from core.xml to an ISO 8601 UTC timestamp, or None"""
+    if not value:
+        return None
+
+    parsed = None
+    for template in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d", "%Y-%m", "%Y"):
+        try:
+            parsed = datetime.datetime.strptime(value[:19], template)
+            break
+        except ValueError:
+            continue
+    if parsed is None:
+        return None
+
+    # Apply a numeric timezone offset (e.g. "-08:00") to get UTC
+    offset = value[19:]
+    if len(offset) == 6 and offset[0] in "+-":
+        delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[4:6]))
+        parsed = parsed - delta if offset[0] == "+" else parsed + delta
+    return parsed.replace(tzinfo=datetime.timezone.utc).isoformat()
+
+
+class _DigestReader:
+    """File wrapper that feeds everything read through it into a hash"""
+
+    def __init__(self, stream, digest):
+        self._stream = stream
+        self._digest = digest
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._stream.read(size)
+        self._digest.update(data)
+        return data
+
+
+def _iter_body_elements(doc_path: str, digest) -> Iterator[etree._Element]:
+    """Stream the top-level paragraphs and tables of word/document.xml in document order
+
+    Uses iterparse, so the document is never held as a whole tree: elements
+    already handled are dropped as the next one arrives. Paragraphs inside
+    tables are yielded as part of their table. The raw XML is fed to digest.
+    """
+    with zipfile.ZipFile(doc_path) as docx_zip, docx_zip.open("word/document.xml") as stream:
+        for _, element in etree.iterparse(_DigestReader(stream, digest), events=("end",), tag=(_W_P, _W_TBL)):
+            parent = element.getparent()
+            if parent is None or parent.tag != _W_BODY:
+                continue
+            # Release the paragraphs and tables handled before this one
+            while element.getprevious() is not None:
+                del parent[0]
+            yield element
+
+
+def _paragraph_text(paragraph: etree._Element) -> str:
+    """Text of a w:p element, read the way python-docx's Paragraph.text reads it
+
+    Only the paragraph's own runs (and those of its hyperlinks) count, so text
+    boxes anchored in a run are left out. Tabs become "\\t", and line breaks
+    and carriage returns "\\n"; page and column breaks add nothing.
+    """
+    parts = []
+    for run in _xpath_runs(paragraph):
+        for child in run:
+            tag = child.tag
+            if tag == _W_T:
+                parts.append(child.text or "")
+            elif tag == _W_BR:
+                if child.get(_W_TYPE, "textWrapping") == "textWrapping":
+                    parts.append("\n")
+            elif tag in _W_RUN_CHARS:
+                parts.append(_W_RUN_CHARS[tag])
+    return "".join(parts)
+
+
+class _CachedDocument(msgspec.Struct):
+    """Parsed document as stored in the document cache (section lists are rebuilt on load)"""
+    version: str
+    structure: List[dict]
+    sections: Dict[int, dict]
+    metadata: dict
+    fingerprint: str
+
+
+def _document_cache_path(doc_path: str) -> Optional[str]:
+    """Cache file for a document's parsed structure, or None when caching is off
+
+    Keyed by the file's path, size and modification time, so an edited
+    document misses the cache without its bytes being read.
+    """
+    if not LLM_CACHE_DIR:
+        return None
+    stat = os.stat(doc_path)
+    key = hashlib.sha256(f"{os.path.abspath(doc_path)}\x00{stat.st_size}\x00{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+    return os.path.join(LLM_CACHE_DIR, "documents", f"{key}.json")
+
+
+def _document_cache_get(path: str) -> Optional[dict]:
+    """Return the cached document data at path, or None if missing or stale"""
+    try:
+        with open(path, "rb") as f:
+            cached = _json_decoder(_CachedDocument).decode(f.read())
+    except (OSError, msgspec.DecodeError):
+        return None
+    if cached.version != DOCUMENT_CACHE_VERSION:
+        return None
+    return {
+        "structure": cached.structure,
+        "sections": cached.sections,
+        "metadata": cached.metadata,
+        "fingerprint": cached.fingerprint,
+        "_soa": build_section_arrays(cached.structure, cached.sections)
+    }
+
+
+def _document_cache_put(path: str, doc_data: dict):
+    """Store parsed document data at path (written atomically)"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_encoder.encode(_CachedDocument(
+            version=DOCUMENT_CACHE_VERSION,
+            structure=doc_data["structure"],
+            sections=doc_data["sections"],
+            metadata=doc_data["metadata"],
+            fingerprint=doc_data["fingerprint"],
+        )))
+    os.replace(tmp_path, path)
+
+
 def extract_document_structure(doc_path: str) -> dict:
     """Extract document structure (headings hierarchy) from Word document
 
@@ -356,23 +1177,44 @@ def extract_document_structure(doc_path: str) -> dict:
         dict with:
             - 'structure': List of headings with their levels and indices
             - 'sections': Dict mapping section indices to their content
-            - 'full_content': Full document content
             - 'metadata': Document metadata (author, created, modified, etc.)
+            - 'fingerprint': SHA-256 of the document body XML
+            - '_soa': Section lists for the retrieval tools (see build_section_arrays)
     """
     print(f"[Extracting] Document structure from: {doc_path}")
-    doc = Document(doc_path)
+
+    # Unchanged documents are answered from the document cache when KB_CACHE_DIR is set
+    cache_path = _document_cache_path(doc_path)
+    if cache_path:
+        doc_data = _document_cache_get(cache_path)
+        if doc_data is not None:
+            print(f"[CACHE] Reusing parsed structure: {len(doc_data['structure'])} sections\n")
+            return doc_data
+
+    # Read only the parts we need straight from the .docx zip - no python-docx object graph
+    with zipfile.ZipFile(doc_path) as docx_zip:
+        style_names = _read_style_names(docx_zip)
+        core_props = _read_core_properties(docx_zip)
+    fingerprint = hashlib.sha256()
+
+    # Section level for each heading style ID, so paragraphs are classified by the
+    # raw pStyle value with one lookup (unstyled and unknown IDs are body text)
+    heading_levels = {}
+    for style_id, style_name in style_names.items():
+        level = _heading_level(style_name)
+        if level is not None:
+            heading_levels[style_id] = level
 
     # Extract document metadata
-    doc_props = doc.core_properties
     doc_metadata = {
-        "author": doc_props.author or "Unknown",
-        "created": doc_props.created.isoformat() if doc_props.created else None,
-        "modified": doc_props.modified.isoformat() if doc_props.modified else None,
-        "last_modified_by": doc_props.last_modified_by or "Unknown",
-        "revision": doc_props.revision,
-        "title": doc_props.title or Path(doc_path).stem,
-        "subject": doc_props.subject or "",
-        "keywords": doc_props.keywords or "",
+        "author": core_props.get("creator") or "Unknown",
+        "created": _parse_w3cdtf(core_props.get("created")),
+        "modified": _parse_w3cdtf(core_props.get("modified")),
+        "last_modified_by": core_props.get("lastModifiedBy") or "Unknown",
+        "revision": int(core_props["revision"]) if core_props.get("revision", "").isdigit() else 0,
+        "title": core_props.get("title") or Path(doc_path).stem,
+        "subject": core_props.get("subject") or "",
+        "keywords": core_props.get("keywords") or "",
     }
 
     structure = []
@@ -380,15 +1222,31 @@ def extract_document_structure(doc_path: str) -> dict:
     current_section = {"index": 0, "heading": "Introduction", "level": 0, "content": []}
     section_index = 0
 
-    for para in doc.paragraphs:
-        if not para.text.strip():
+    # Stream the body XML once, in document order, so tables land in the section they belong to
+    for element in _iter_body_elements(doc_path, fingerprint):
+        if element.tag == _W_TBL:
+            # Table lines go straight into the section's parts; the empty part
+            # becomes the blank line before [TABLE] when the section is joined
+            content_parts = current_section["content"]
+            content_parts.append("")
+            content_parts.append("[TABLE]")
+            for row in element.iterchildren(_W_TR):
+                content_parts.append(" | ".join([
+                    "\n".join([_paragraph_text(cell_para) for cell_para in cell.iterchildren(_W_P)])
+                    for cell in row.iterchildren(_W_TC)
+                ]))
+            content_parts.append("[/TABLE]")
+            continue
+
+        text = _paragraph_text(element).strip()
+        if not text:
             continue
 
-        style = para.style.name
-        text = para.text.strip()
+        style_ids = _xpath_style(element)
 
         # Check if this is a heading
-        if 'Heading' in style:
+        level = heading_levels.get(style_ids[0]) if style_ids else None
+        if level is not None:
             # Save previous section
             if current_section["content"]:
                 sections[current_section["index"]] = {
@@ -399,17 +1257,6 @@ def extract_document_structure(doc_path: str) -> dict:
 
             # Start new section
             section_index += 1
-            level = 1
-            if 'Heading 1' in style:
-                level = 1
-            elif 'Heading 2' in style:
-                level = 2
-            elif 'Heading 3' in style:
-                level = 3
-            elif 'Heading 4' in style:
-                level = 4
-            else:
-                level = 5
 
             current_section = {
                 "index": section_index,
@@ -435,109 +1282,342 @@ def extract_document_structure(doc_path: str) -> dict:
             "content": "\n".join(current_section["content"])
         }
 
-    # Extract tables and add to sections
-    for table in doc.tables:
-        table_content = ["[TABLE]"]
-        for row in table.rows:
-            row_text = " | ".join(cell.text for cell in row.cells)
-            table_content.append(row_text)
-        table_content.append("[/TABLE]")
-
-        # Add table to the last section (or create a Tables section if needed)
-        if section_index in sections:
-            sections[section_index]["content"] += "\n\n" + "\n".join(table_content)
-
-    # Build full content
-    full_content = "\n\n".join([para.text for para in doc.paragraphs if para.text.strip()])
-
     print(f"[OK] Found {len(structure)} sections")
     print(f"[Metadata] Author: {doc_metadata['author']}, Modified: {doc_metadata['modified'] or 'Unknown'}\n")
 
-    return {
+    doc_data = {
         "structure": structure,
         "sections": sections,
-        "full_content": full_content,
-        "metadata": doc_metadata
+        "metadata": doc_metadata,
+        "fingerprint": fingerprint.hexdigest(),
+        "_soa": build_section_arrays(structure, sections)
     }
+    if cache_path:
+        _document_cache_put(cache_path, doc_data)
+    return doc_data
 
 
-# ============================================================================
-# Document Retrieval Functions (called by AI as tools)
-# ============================================================================
+def skim_document(doc_data: dict, limit: int = SKIM_CHARS) -> str:
+    """Build a compact digest of the informative parts of a document
 
-def get_section_by_index(section_index: int) -> str:
-    """Retrieve a specific section from the document by its index.
+    Keeps headings, tables and body lines of at least SKIM_MIN_LINE_CHARS
+    characters, dropping short lines such as page numbers, headers/footers
+    and captions, so the extractors see more real content per prompt token.
 
     Args:
-        section_index: The index number of the section to retrieve (starting from 1)
+        doc_data: Document data returned by extract_document_structure
+        limit: Maximum length of the digest in characters
 
     Returns:
-        The content of the requested section including its heading
+        The digest, with headings rendered as markdown headings
     """
-    global _current_document_data
-
-    import datetime
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-    print(f"      [{timestamp}] [TOOL CALL] get_section_by_index({section_index})")
-
-    if _current_document_data is None:
-        return "Error: No document is currently loaded"
-
-    sections = _current_document_data.get("sections", {})
+    sections = doc_data.get("sections", {})
+    headings = {item["index"]: item for item in doc_data.get("structure", [])}
+
+    parts = []
+    size = 0
+    for index in sorted(set(sections) | set(headings)):
+        lines = []
+        if index in headings:
+            heading = headings[index]
+            lines.append(f"{'#' * heading['level']} {heading['heading']}")
+        if index in sections:
+            for line in sections[index]["content"].split("\n"):
+                line = line.strip()
+                if len(line) >= SKIM_MIN_LINE_CHARS or line.startswith("[TABLE]") or line.startswith("[/TABLE]") or " | " in line:
+                    lines.append(line)
+
+        block = "\n".join(lines)
+        if not block:
+            continue
+        parts.append(block)
+        size += len(block) + 2
+        if size >= limit:
+            break
 
-    if section_index not in sections:
-        available = ", ".join(str(i) for i in sorted(sections.keys()))
-        return f"Error: Section {section_index} not found. Available sections: {available}"
+    return "\n\n".join(parts)[:limit]
 
-    section = sections[section_index]
-    print(f"      [{timestamp}] [RETRIEVED] Section {section_index}: {section['heading']}")
-    return f"# {section['heading']}\n\n{section['content']}"
 
+def build_metadata_sample(doc_data: dict, limit: int = METADATA_SAMPLE_CHARS) -> str:
+    """Build the document sample used to identify products, client, type and category
 
-def get_section_by_heading(heading_keyword: str) -> str:
-    """Search for and retrieve a section by heading name or keyword.
+    Keeps, in document order, each heading with the first METADATA_SECTION_CHARS
+    characters of its section, plus any later line of the section that names
+    something next to a keyword such as "system", "software" or "client". That
+    is where the metadata signal is, at a fraction of the size of the digest.
 
     Args:
-        heading_keyword: A keyword or phrase to search for in section headings
+        doc_data: Document data returned by extract_document_structure
+        limit: Maximum length of the sample in characters
 
     Returns:
-        The content of the first matching section, or list of matches if multiple found
+        The sample, with headings rendered as markdown headings
     """
-    global _current_document_data
+    soa = doc_data["_soa"]
+    headings, levels, contents = soa["headings"], soa["levels"], soa["contents"]
+
+    parts = []
+    size = 0
+    for index, content in enumerate(contents):
+        lines = []
+        if index and headings[index]:
+            lines.append(f"{'#' * levels[index]} {headings[index]}")
+        if content:
+            lines.append(content[:METADATA_SECTION_CHARS])
+            for line in content[METADATA_SECTION_CHARS:].split("\n"):
+                if _METADATA_KEYWORD_RE.search(line) and _PROPER_NAME_RE.search(line):
+                    lines.append(line.strip())
+
+        if not lines:
+            continue
+        block = "\n".join(lines)
+        parts.append(block)
+        size += len(block) + 2
+        if size >= limit:
+            break
 
-    import datetime
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-    print(f"      [{timestamp}] [TOOL CALL] get_section_by_heading('{heading_keyword}')")
+    return "\n\n".join(parts)[:limit]
 
-    if _current_document_data is None:
-        return "Error: No document is currently loaded"
 
-    sections = _current_document_data.get("sections", {})
-    structure = _current_document_data.get("structure", [])
+def has_likely_entities(text: str, known_names: List[str] = ()) -> bool:
+    """Whether text plausibly names a product or client, so metadata extraction is worth a call
 
-    # Find matching sections
-    matches = []
-    for item in structure:
-        if heading_keyword.lower() in item["heading"].lower():
-            matches.append(item)
+    True if it mentions a product or client already in the knowledge base,
+    contains an acronym, or has at least MIN_NAME_PHRASES capitalized
+    multi-word phrases.
+    """
+    lowered = text.lower()
+    if any(name.lower() in lowered for name in known_names):
+        return True
+    if _ACRONYM_RE.search(text):
+        return True
+    phrases = 0
+    for _ in _NAME_PHRASE_RE.finditer(text):
+        phrases += 1
+        if phrases >= MIN_NAME_PHRASES:
+            return True
+    return False
 
-    if not matches:
-        return f"Error: No sections found matching '{heading_keyword}'"
 
-    if len(matches) == 1:
-        idx = matches[0]["index"]
-        section = sections[idx]
-        print(f"      [{timestamp}] [RETRIEVED] Section {idx}: {section['heading']}")
-        return f"# {section['heading']}\n\n{section['content']}"
-    else:
-        # Multiple matches - return list
-        match_list = "\n".join([f"  {m['index']}. {m['heading']}" for m in matches])
-        print(f"      [{timestamp}] [RETRIEVED] {len(matches)} matching sections")
-        return f"Multiple sections found matching '{heading_keyword}':\n{match_list}\n\nUse get_section_by_index() to retrieve a specific one."
+@functools.lru_cache(maxsize=8)
+def _lexicon_pattern(names: tuple) -> re.Pattern:
+    """One case-insensitive pattern for any of names, longest first so the longest name wins"""
+    alternatives = "|".join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+    return re.compile(rf'(?<!\w)(?:{alternatives})(?!\w)', re.I)
 
 
-def get_multiple_sections(section_indices: list) -> str:
-    """Retrieve multiple sections at once by their indices.
+def spot_known_products(text: str, known_products: List[str], known_names: List[str] = ()) -> Optional[List[str]]:
+    """Find the known products a document substantially discusses, without the model
+
+    A single pass of one pattern over the text counts the mentions of every known
+    name. A product is kept with LEXICON_MIN_HITS mentions, or with a mention on
+    a line with a technical keyword such as "configure" or "install".
+
+    Args:
+        text: Document text, normally its metadata sample
+        known_products: Products already in the knowledge base
+        known_names: Other known names (clients) that are not new products
+
+    Returns:
+        The products in order of first mention, or None if the lexicon can't settle it:
+        no known product is discussed, or the text has an acronym outside the known names
+        (possibly a product the knowledge base doesn't have yet)
+    """
+    if not known_products:
+        return None
+    names = tuple(dict.fromkeys([*known_products, *known_names]))
+    pattern = _lexicon_pattern(names)
+    canonical = {name.lower(): name for name in known_products}
+
+    hits: Dict[str, int] = {}
+    technical = set()
+    for line in text.split("\n"):
+        mentions = [canonical[m.lower()] for m in pattern.findall(line) if m.lower() in canonical]
+        if not mentions:
+            continue
+        near_keyword = _TECHNICAL_KEYWORD_RE.search(line) is not None
+        for name in mentions:
+            hits[name] = hits.get(name, 0) + 1
+            if near_keyword:
+                technical.add(name)
+
+    products = [name for name, count in hits.items() if count >= LEXICON_MIN_HITS or name in technical]
+    if not products or _ACRONYM_RE.search(pattern.sub(" ", text)):
+        return None
+    return products
+
+
+def get_structure_summary(doc_data: dict) -> str:
+    """Outline of the document's headings for the tool-based extractors
+
+    Rendered on first use and kept on doc_data, since every product
+    extracted from the document sends the same outline.
+    """
+    summary = doc_data.get("_structure_summary")
+    if summary is None:
+        summary = "DOCUMENT STRUCTURE:\n" + "".join(
+            f"{'  ' * (item['level'] - 1)}{item['index']}. {item['heading']} (Level {item['level']})\n"
+            for item in doc_data.get("structure", [])
+        )
+        doc_data["_structure_summary"] = summary
+    return summary
+
+
+# ============================================================================
+# Document Retrieval Functions (called by AI as tools)
+# ============================================================================
+
+def build_section_arrays(structure: List[dict], sections: Dict[int, dict]) -> dict:
+    """Lay out a document's sections as parallel lists indexed by section index
+
+    Built once per document so the retrieval tools do list lookups instead of
+    dict lookups on every call. Index 0 is the untitled introduction; entries
+    for headings without body text have None content.
+
+    Returns:
+        dict with 'headings', 'headings_lc', 'levels' and 'contents' lists,
+        'heading_index' mapping each lowercased heading word to the sections using it,
+        'sorted_headings'/'sorted_indices' (lowercased headings in sorted order and
+        their sections, for prefix search) and an empty 'token_hits' memo filled in
+        by _heading_candidates
+    """
+    size = max([item["index"] for item in structure] + list(sections) + [0]) + 1
+    headings = ["Introduction"] + [""] * (size - 1)
+    levels = [0] * size
+    contents = [None] * size
+    for item in structure:
+        headings[item["index"]] = item["heading"]
+        levels[item["index"]] = item["level"]
+    for index, section in sections.items():
+        headings[index] = section["heading"]
+        levels[index] = section["level"]
+        contents[index] = section["content"]
+    headings_lc = [heading.lower() for heading in headings]
+    heading_index = {}
+    for index, heading_lc in enumerate(headings_lc):
+        if index:
+            for word in set(heading_lc.split()):
+                heading_index.setdefault(word, []).append(index)
+    by_heading = sorted((heading_lc, index) for index, heading_lc in enumerate(headings_lc) if index)
+    return {
+        "headings": headings,
+        "headings_lc": headings_lc,
+        "sorted_headings": [heading_lc for heading_lc, _ in by_heading],
+        "sorted_indices": [index for _, index in by_heading],
+        "levels": levels,
+        "contents": contents,
+        "heading_index": heading_index,
+        "token_hits": {},
+    }
+
+
+def _heading_candidates(soa: dict, needle: str):
+    """Sections whose heading could contain needle, from the heading word index
+
+    Every whitespace-separated token of the needle must fall inside a single
+    heading word, so only sections having, for each token, some word that
+    contains it are returned. Callers still check the full substring.
+
+    The sections for each token are memoized on the document, since the same
+    keywords come back across tool calls and across products.
+    """
+    tokens = needle.split()
+    if not tokens:
+        return range(1, len(soa["headings_lc"]))
+
+    heading_index = soa["heading_index"]
+    token_hits = soa["token_hits"]
+    candidates = None
+    for token in tokens:
+        hits = token_hits.get(token)
+        if hits is None:
+            hits = frozenset(index for word, indices in heading_index.items() if token in word for index in indices)
+            token_hits[token] = hits
+        candidates = hits if candidates is None else candidates & hits
+        if not candidates:
+            break
+    return sorted(candidates)
+
+
+def get_section_by_index(section_index: int) -> str:
+    """Retrieve a specific section from the document by its index.
+
+    Args:
+        section_index: The index number of the section to retrieve (starting from 1)
+
+    Returns:
+        The content of the requested section including its heading
+    """
+    timestamp = time.strftime("%H:%M:%S")
+    log.info("      [%s] [TOOL CALL] get_section_by_index(%s)", timestamp, section_index)
+
+    document_data = _get_current_document()
+    if document_data is None:
+        return "Error: No document is currently loaded"
+
+    soa = document_data["_soa"]
+    contents = soa["contents"]
+
+    if not isinstance(section_index, int) or not 0 <= section_index < len(contents) or contents[section_index] is None:
+        available = ", ".join(str(i) for i, content in enumerate(contents) if content is not None)
+        return f"Error: Section {section_index} not found. Available sections: {available}"
+
+    heading = soa["headings"][section_index]
+    log.info("      [%s] [RETRIEVED] Section %s: %s", timestamp, section_index, heading)
+    return f"# {heading}\n\n{contents[section_index]}"
+
+
+def get_section_by_heading(heading_keyword: str) -> str:
+    """Search for and retrieve a section by heading name or keyword.
+
+    Args:
+        heading_keyword: A keyword or phrase to search for in section headings
+
+    Returns:
+        The content of the first matching section, or list of matches if multiple found
+    """
+    timestamp = time.strftime("%H:%M:%S")
+    log.info("      [%s] [TOOL CALL] get_section_by_heading('%s')", timestamp, heading_keyword)
+
+    document_data = _get_current_document()
+    if document_data is None:
+        return "Error: No document is currently loaded"
+
+    soa = document_data["_soa"]
+    headings = soa["headings"]
+
+    # Find matching sections (headings only - index 0 is the untitled introduction).
+    # Headings starting with the keyword are found by binary search and preferred;
+    # otherwise any heading containing it matches.
+    needle = heading_keyword.lower()
+    sorted_headings = soa["sorted_headings"]
+    start = bisect.bisect_left(sorted_headings, needle)
+    end = bisect.bisect_left(sorted_headings, needle + "\U0010ffff", start)
+    if start < end:
+        matches = sorted(soa["sorted_indices"][start:end])
+    else:
+        headings_lc = soa["headings_lc"]
+        matches = [i for i in _heading_candidates(soa, needle) if needle in headings_lc[i]]
+
+    if not matches:
+        return f"Error: No sections found matching '{heading_keyword}'"
+
+    if len(matches) == 1:
+        idx = matches[0]
+        content = soa["contents"][idx]
+        if content is None:
+            return f"Error: Section {idx} ({headings[idx]}) has no content"
+        log.info("      [%s] [RETRIEVED] Section %s: %s", timestamp, idx, headings[idx])
+        return f"# {headings[idx]}\n\n{content}"
+    else:
+        # Multiple matches - return list
+        match_list = "\n".join([f"  {i}. {headings[i]}" for i in matches])
+        log.info("      [%s] [RETRIEVED] %d matching sections", timestamp, len(matches))
+        return f"Multiple sections found matching '{heading_keyword}':\n{match_list}\n\nUse get_section_by_index() to retrieve a specific one."
+
+
+def get_multiple_sections(section_indices: list) -> str:
+    """Retrieve multiple sections at once by their indices.
 
     Args:
         section_indices: List of section index numbers to retrieve
@@ -545,37 +1625,77 @@ def get_multiple_sections(section_indices: list) -> str:
     Returns:
         Combined content of all requested sections
     """
-    global _current_document_data
+    timestamp = time.strftime("%H:%M:%S")
+    log.info("      [%s] [TOOL CALL] get_multiple_sections(%s)", timestamp, section_indices)
 
-    import datetime
-    timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-    print(f"      [{timestamp}] [TOOL CALL] get_multiple_sections({section_indices})")
-
-    if _current_document_data is None:
+    document_data = _get_current_document()
+    if document_data is None:
         return "Error: No document is currently loaded"
 
-    sections = _current_document_data.get("sections", {})
+    soa = document_data["_soa"]
+    headings = soa["headings"]
+    contents = soa["contents"]
     result = []
 
     retrieved_count = 0
     for idx in section_indices:
-        if idx in sections:
-            section = sections[idx]
-            result.append(f"# {section['heading']}\n\n{section['content']}\n")
+        if isinstance(idx, int) and 0 <= idx < len(contents) and contents[idx] is not None:
+            result.append(f"# {headings[idx]}\n\n{contents[idx]}\n")
             retrieved_count += 1
         else:
             result.append(f"[Section {idx} not found]\n")
 
-    print(f"      [{timestamp}] [RETRIEVED] {retrieved_count}/{len(section_indices)} sections")
+    log.info("      [%s] [RETRIEVED] %d/%d sections", timestamp, retrieved_count, len(section_indices))
     return "\n---\n\n".join(result)
 
 
+# Retrieval tools offered to the extractors that work from the document sections
+DOCUMENT_TOOLS = [get_section_by_index, get_section_by_heading, get_multiple_sections]
+
+
 # ============================================================================
 # Helper Functions
 # ============================================================================
 
+@functools.lru_cache(maxsize=None)
+def get_client(api_key: str, base_url: str) -> OpenAI:
+    """Return the shared OpenAI client for an endpoint
+
+    The client is thread-safe and keeps a pooled HTTP connection, so every
+    extractor and worker thread reuses one instance instead of constructing its own.
+    The pool keeps a warm connection for each of the MAX_CONCURRENT_REQUESTS
+    requests that can be in flight, so none of them waits on a TLS handshake,
+    and with HTTP/2 they all share one multiplexed connection.
+    The SDK's own retries are turned off so that create_completion's
+    API_RETRY_BUDGET loop is the only place a request is retried.
+
+    Args:
+        api_key: Moonshot API key
+        base_url: Moonshot API base URL
+
+    Returns:
+        Cached OpenAI client
+    """
+    if httpx is None:
+        return OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+    http_client = DefaultHttpxClient(
+        http2=_HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_REQUESTS,
+            max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+
+
+@functools.lru_cache(maxsize=1)
 def get_company_context() -> str:
-    """Build company context string for AI prompts"""
+    """Build company context string for AI prompts
+
+    The COMPANY_* settings are read once at startup, so the string is built
+    once and reused by every prompt.
+    """
     context_parts = []
 
     if COMPANY_NAME:
@@ -594,28 +1714,68 @@ def get_company_context() -> str:
     return ""
 
 
-# ============================================================================
-# Extraction Functions
-# ============================================================================
+def set_quality(tier: str):
+    """Select the models used by the extractors
+
+    Args:
+        tier: One of QUALITY_TIERS ("fast", "balanced" or "high")
+    """
+    ACTIVE_MODELS.update(QUALITY_TIERS[tier])
+
 
-def extract_metadata(content: str, client: OpenAI, existing_structure: str) -> dict:
-    """Extract metadata: products mentioned, client name, document type"""
-    print("[Extracting] Document metadata...")
+def run_with_escalation(run: Callable[[str], Any], is_acceptable: Callable[[Any], bool] = lambda result: True) -> Any:
+    """Run a heavy extraction with the active model, escalating when the result is unusable
 
-    sample = content[:15000]
+    If the quality tier defines an escalation model, a call that raises or whose
+    result fails is_acceptable is repeated once with that model.
+
+    Args:
+        run: Function taking a model name and performing the extraction
+        is_acceptable: Check applied to the first result
 
-    company_context = get_company_context()
+    Returns:
+        The extraction result
+    """
+    model = ACTIVE_MODELS["heavy"]
+    escalate = ACTIVE_MODELS["escalate"]
+    if not escalate or escalate == model:
+        return run(model)
 
     try:
-        result = run_with_tools(
-            client=client,
-            model=MODEL_FAST,
-            prompt=f"""{company_context}Analyze this document intelligently and extract all relevant metadata.
+        result = run(model)
+        if is_acceptable(result):
+            return result
+        print(f"      [ESCALATE] Weak result from {model}, retrying with {escalate}")
+    except Exception as e:
+        print(f"      [ESCALATE] {model} failed ({e}), retrying with {escalate}")
+    return run(escalate)
 
-            {existing_structure}
 
-            DOCUMENT CONTENT:
-            {sample}
+def _is_insufficient(product_name: str, doc_data: dict) -> bool:
+    """Whether a document only mentions a product in passing (see MIN_PRODUCT_MENTIONS)"""
+    soa = doc_data["_soa"]
+    needle = product_name.lower()
+    if any(needle in heading for heading in soa["headings_lc"]):
+        return False
+    mentions = 0
+    for content in soa["contents"]:
+        if content:
+            mentions += content.lower().count(needle)
+            if mentions >= MIN_PRODUCT_MENTIONS:
+                return False
+    return True
+
+
+def _has_enough_knowledge(knowledge: str) -> bool:
+    """Whether product knowledge is worth keeping without escalation"""
+    return "INSUFFICIENT_INFORMATION" in knowledge or len(knowledge.strip()) >= MIN_KNOWLEDGE_CHARS
+
+
+# ============================================================================
+# Prompt Templates (%-formatted, filled in by the extraction functions)
+# ============================================================================
+
+_METADATA_PROMPT = """%(company_context)sAnalyze the document below intelligently and extract all relevant metadata.
 
             INSTRUCTIONS:
             1. **Products/Systems**: Identify products/systems that are SUBSTANTIALLY discussed
@@ -623,13 +1783,13 @@ def extract_metadata(content: str, client: OpenAI, existing_structure: str) -> d
                - EXCLUDE if: Just mentioned in passing, listed in a table, or used as an example
                - Look for: Product names, software systems, equipment models, platforms, tools
                - Examples: "BULKmetrix", "QMS", "Insight CM", "Azure DevOps", "Tortoise Git"
-               - If products already exist in structure above, use EXACT same name
+               - If products already exist in the structure below, use EXACT same name
                - Quality over quantity - better to miss a minor mention than create useless stubs
 
             2. **Client**: Identify the client/customer this document is for
                - Look for: Company names, project names, client references
-               - Distinguish between: our company ({COMPANY_NAME or 'us'}), the client, and vendors
-               - If client exists in structure above, use EXACT same name
+               - Distinguish between: our company (%(company_name)s), the client, and vendors
+               - If client exists in the structure below, use EXACT same name
                - Return null if this is internal documentation (no specific client)
 
             3. **Document Type**: What kind of document is this?
@@ -642,70 +1802,63 @@ def extract_metadata(content: str, client: OpenAI, existing_structure: str) -> d
                  "Installation", "Configuration", "Maintenance", "Safety", "Engineering"
 
             Return ONLY valid JSON in this exact format:
-            {{
+            {
                 "products": ["Product1", "Product2"],
                 "client_name": "ClientName or null",
                 "document_type": "DocumentType",
                 "document_category": "Category"
-            }}
-            """,
-            return_type=str,
-            timeout=120
-        )
+            }
 
-        # Parse JSON
-        metadata = parse_json_response(result)
-        print(f"[OK] Found: {len(metadata.get('products', []))} products, Client: {metadata.get('client_name', 'Unknown')}\n")
-        return metadata
+            %(existing_structure)s
 
-    except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"[ERROR] Failed to extract metadata: {e}")
-        print(f"   Details: {error_details[:500]}...\n")
-        return {
-            "products": [],
-            "client_name": None,
-            "document_type": "Unknown",
-            "document_category": "General"
-        }
+            DOCUMENT CONTENT:
+            %(sample)s
+            """
 
+_CLASSIFICATION_PROMPT = """%(company_context)sAnalyze the document below and classify it. The products it covers are already known.
 
-def extract_product_knowledge(product_name: str, doc_data: dict, client: OpenAI, existing_structure: str) -> str:
-    """Extract knowledge about a specific product using tool-based retrieval"""
-    global _current_document_data
-    _current_document_data = doc_data
+            INSTRUCTIONS:
+            1. **Client**: Identify the client/customer this document is for
+               - Look for: Company names, project names, client references
+               - Distinguish between: our company (%(company_name)s), the client, and vendors
+               - If client exists in the structure below, use EXACT same name
+               - Return null if this is internal documentation (no specific client)
 
-    print(f"   [Product] Extracting knowledge for: {product_name}")
+            2. **Document Type**: What kind of document is this?
+               - Examples: "User Manual", "Technical Specification", "How-To Guide",
+                 "Installation Guide", "Configuration Guide", "Process Document",
+                 "Technical Guide", "Reference Manual", "Standard Operating Procedure"
 
-    # Build structure summary for the AI
-    structure = doc_data.get("structure", [])
-    structure_summary = "DOCUMENT STRUCTURE:\n"
-    for item in structure:
-        indent = "  " * (item["level"] - 1)
-        structure_summary += f"{indent}{item['index']}. {item['heading']} (Level {item['level']})\n"
+            3. **Document Category**: What technical area does this cover?
+               - Examples: "Version Control", "Controls Systems", "Electrical",
+                 "Installation", "Configuration", "Maintenance", "Safety", "Engineering"
 
-    company_context = get_company_context()
+            Return ONLY valid JSON in this exact format:
+            {
+                "client_name": "ClientName or null",
+                "document_type": "DocumentType",
+                "document_category": "Category"
+            }
 
-    try:
-        result = run_with_tools(
-            client=client,
-            model=MODEL_SMART,
-            prompt=f"""{company_context}You are analyzing a technical document to extract knowledge about {product_name}.
+            %(existing_structure)s
 
-            {existing_structure}
+            PRODUCTS COVERED: %(products)s
 
-            NOTE: If {product_name} already exists in the structure above, this content will be ADDED to existing knowledge.
-            Focus on extracting NEW information that complements what might already exist.
+            DOCUMENT CONTENT:
+            %(sample)s
+            """
+
+_PRODUCT_KNOWLEDGE_PROMPT = """%(company_context)sYou are analyzing a technical document to extract knowledge about the product named at the end.
 
-            {structure_summary}
+            TASK: Write a professional wiki article about the product.
 
-            TASK: Write a professional wiki article about {product_name}.
+            NOTE: If the product already exists in the knowledge base structure below, this content will be ADDED to existing knowledge.
+            Focus on extracting NEW information that complements what might already exist.
 
             CRITICAL - INSUFFICIENT INFORMATION DETECTION:
-            - If {product_name} is only mentioned in passing (1-2 brief mentions)
-            - If there's no technical information about {product_name}
-            - If {product_name} is just listed as an example or in a table
+            - If the product is only mentioned in passing (1-2 brief mentions)
+            - If there's no technical information about the product
+            - If the product is just listed as an example or in a table
             - Then return ONLY this text: "INSUFFICIENT_INFORMATION"
             - Do NOT create a stub article - just return the marker
 
@@ -726,7 +1879,7 @@ def extract_product_knowledge(product_name: str, doc_data: dict, client: OpenAI,
             Create a wiki article with these sections (only include sections with actual content):
 
             ## Overview
-            What {product_name} is, its purpose, and how it's used in our industry.
+            What the product is, its purpose, and how it's used in our industry.
 
             ## Features & Capabilities
             List features, technical specifications, and key functionalities.
@@ -747,68 +1900,30 @@ def extract_product_knowledge(product_name: str, doc_data: dict, client: OpenAI,
             How we configure/customize it, common issues, solutions, best practices.
 
             INSTRUCTIONS:
-            1. Use the tools to retrieve sections about {product_name}
+            1. Use the tools to retrieve sections about the product
             2. Write clean, direct wiki content
             3. Use present tense (e.g., "Git is...", not "The document describes Git as...")
             4. Include tables, lists, code blocks where appropriate
             5. Be specific and technical - avoid generic statements
             6. If minimal information exists, write brief article and stop
 
-            CRITICAL: Your response must START with "## Overview" immediately.
-            NO text before it. NO explanations. NO "Based on...". NO "I will...".
-            Return ONLY pure wiki article markdown - start with ## Overview heading.
-            """,
-            functions=[get_section_by_index, get_section_by_heading, get_multiple_sections],
-            return_type=str,
-            timeout=300
-        )
-
-        print(f"   [OK] Extracted {len(result)} characters of knowledge\n")
-        return result
-
-    except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"   [ERROR] Failed to extract product knowledge: {e}")
-        print(f"   Details: {error_details[:500]}...\n")
-        return f"# {product_name}\n\nError extracting knowledge: {e}\n\nDetails:\n{error_details}"
-
-    finally:
-        # Always clean up global state
-        _current_document_data = None
-
-
-def extract_document_template(product_name: str, doc_data: dict, client: OpenAI, existing_structure: str) -> list:
-    """Extract reusable reference materials from document using tool-based retrieval"""
-    global _current_document_data
-    _current_document_data = doc_data
+            %(structure_summary)s
 
-    print(f"   [Analyzing] Document for reusable reference materials: {product_name}")
+            %(existing_structure)s
 
-    # Build structure summary for the AI
-    structure = doc_data.get("structure", [])
-    structure_summary = "DOCUMENT STRUCTURE:\n"
-    for item in structure:
-        indent = "  " * (item["level"] - 1)
-        structure_summary += f"{indent}{item['index']}. {item['heading']} (Level {item['level']})\n"
-
-    result = None
-    company_context = get_company_context()
-
-    try:
-        result = run_with_tools(
-            client=client,
-            model=MODEL_SMART,
-            prompt=f"""{company_context}We are building a comprehensive technical knowledge base. Analyze this document intelligently and extract ALL valuable knowledge for future reference.
+            PRODUCT: %(product_name)s
 
-            {existing_structure}
+            CRITICAL: Your response must START with "## Overview" immediately.
+            NO text before it. NO explanations. NO "Based on...". NO "I will...".
+            Return ONLY pure wiki article markdown - start with ## Overview heading.
+            """
 
-            {structure_summary}
+_REFERENCE_MATERIALS_PROMPT = """%(company_context)sWe are building a comprehensive technical knowledge base. Analyze the document below intelligently and extract ALL valuable knowledge for future reference.
 
             TASK: Identify 1-3 different ways this document provides valuable knowledge. Think beyond just the document itself - extract the KNOWLEDGE it contains.
 
             INSTRUCTIONS:
-            1. Review the document structure above
+            1. Review the document structure below
             2. Use the provided tools to retrieve relevant sections
             3. Extract knowledge that would be useful to engineers, technicians, and project teams
 
@@ -861,13 +1976,13 @@ def extract_document_template(product_name: str, doc_data: dict, client: OpenAI,
 
             Return a JSON array of 1-3 knowledge items:
             [
-                {{
+                {
                     "type": "HOW_TO",
                     "title": "How to Configure Git Repositories",
                     "category": "Version Control",
                     "content": "# How to Configure Git Repositories\\n\\n## Overview\\n...full content...",
                     "tags": ["git", "version-control", "configuration", "repository"]
-                }}
+                }
             ]
 
             CRITICAL - WIKI CONTENT REQUIREMENTS:
@@ -878,7 +1993,7 @@ def extract_document_template(product_name: str, doc_data: dict, client: OpenAI,
             - NO explanatory text before the heading - start immediately with #
             - Use present tense, factual, encyclopedic style
             - Extract COMPLETE content, not summaries
-            - Be specific to {product_name} where relevant
+            - Be specific to the product named at the end where relevant
             - Include code blocks, tables, lists as appropriate
 
             WRONG (DO NOT put this in content):
@@ -887,388 +2002,1308 @@ def extract_document_template(product_name: str, doc_data: dict, client: OpenAI,
             RIGHT (DO put this in content):
             "# How to Install Git\\n\\nGit is installed by downloading..."
 
-            Return ONLY valid JSON array, no preamble or explanation before it.
-            """,
-            functions=[get_section_by_index, get_section_by_heading, get_multiple_sections],
-            return_type=list,
-            timeout=300
-        )
-
-        # Parse JSON if it's a string
-        if isinstance(result, str):
-            result = parse_json_response(result)
-
-        if not isinstance(result, list):
-            result = [result]
-
-        print(f"   [OK] Identified {len(result)} reference material(s)\n")
-        return result
-
-    except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"   [ERROR] Failed to extract reference materials: {e}")
-        print(f"   Details: {error_details[:500]}...")
-        if result:
-            print(f"   [DEBUG] Raw result: {result[:500]}...\n")
-        return []
-
-    finally:
-        # Always clean up global state
-        _current_document_data = None
-
-
-def extract_client_info(client_name: str, content: str, client: OpenAI, existing_structure: str) -> dict:
-    """Extract client information split into categories"""
-    # Skip if no valid client name
-    if not client_name or client_name.lower() in ['none', 'unknown', 'n/a']:
-        return {}
+            %(structure_summary)s
 
-    print(f"   [Client] Extracting information for: {client_name}")
+            %(existing_structure)s
 
-    sample = content[:20000]
+            PRODUCT: %(product_name)s
 
-    try:
-        result = run_with_tools(
-            client=client,
-            model=MODEL_FAST,
-            prompt=f"""Extract information about {client_name} from this document and organize into categories.
+            Return ONLY valid JSON array, no preamble or explanation before it.
+            """
 
-            {existing_structure}
+_CLIENT_INFO_PROMPT = """Extract information about the client named at the end from the document below and organize into categories.
 
-            NOTE: Check if {client_name} already exists in the structure above.
+            NOTE: Check if the client already exists in the knowledge base structure below.
             If they do, check what categories already exist (e.g., overview.md, locations.md, hardware.md).
             You can use existing categories OR suggest new ones that fit the pattern.
 
-            DOCUMENT CONTENT:
-            {sample}
-
             Return ONLY valid JSON in this exact format:
-            {{
+            {
                 "overview": "Brief overview of the client and project",
                 "locations": ["Location 1 with details", "Location 2 with details"],
                 "hardware": ["Hardware item 1", "Hardware item 2"],
                 "configuration": ["Config detail 1", "Config detail 2"],
                 "contacts": ["Contact 1", "Contact 2"]
-            }}
+            }
 
             You can add additional categories if needed (e.g., "software", "network", "security").
             Be comprehensive and extract all relevant details.
-            """,
-            return_type=str,
-            timeout=120
-        )
 
-        # Parse JSON
-        client_data = parse_json_response(result)
-        print(f"   [OK] Extracted {len(client_data)} categories\n")
-        return client_data
+            %(existing_structure)s
 
-    except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"   [ERROR] Failed to extract client info: {e}")
-        print(f"   Details: {error_details[:500]}...\n")
-        return {}
+            DOCUMENT CONTENT:
+            %(sample)s
 
+            CLIENT: %(client_name)s
+            """
 
-# ============================================================================
-# File Saving Functions
-# ============================================================================
+_METADATA_AND_CLIENT_PROMPT = """%(company_context)sAnalyze the document below and extract its metadata and client information in a single response.
 
-def scan_existing_structure(base_dir: str) -> str:
-    """Scan existing knowledge base structure to help AI maintain consistency"""
-    base_path = Path(base_dir)
-    if not base_path.exists():
-        return "EXISTING KNOWLEDGE BASE STRUCTURE: Empty (this is the first document)"
+            INSTRUCTIONS:
+            1. **Metadata**
+               - products: Products/systems that are SUBSTANTIALLY discussed (technical details, procedures,
+                 configuration info). EXCLUDE products only mentioned in passing, listed in a table, or used as an example.
+                 Quality over quantity - better to miss a minor mention than create useless stubs.
+                 If products already exist in the structure below, use EXACT same name.
+               - client_name: The client/customer this document is for - distinguish between our company
+                 (%(company_name)s), the client, and vendors. Use EXACT same name if the client exists in
+                 the structure below. Use null if this is internal documentation.
+               - document_type: e.g. "User Manual", "Technical Specification", "How-To Guide", "Installation Guide"
+               - document_category: e.g. "Version Control", "Controls Systems", "Electrical", "Configuration"
+
+            2. **Client** - if client_name is not null, organize client information into categories:
+               overview (string), locations, hardware, configuration, contacts (lists of strings).
+               If the client already exists in the structure below, reuse its existing categories where they fit.
+               You can add additional categories if needed (e.g., "software", "network", "security").
+               Be comprehensive and extract all relevant details. Use null if there is no client.
 
-    structure_info = ["EXISTING KNOWLEDGE BASE STRUCTURE:"]
+            Return ONLY valid JSON in this exact format:
+            {
+                "metadata": {
+                    "products": ["Product1", "Product2"],
+                    "client_name": "ClientName or null",
+                    "document_type": "DocumentType",
+                    "document_category": "Category"
+                },
+                "client": {
+                    "overview": "Brief overview of the client and project",
+                    "locations": ["Location 1 with details"],
+                    "hardware": ["Hardware item 1"],
+                    "configuration": ["Config detail 1"],
+                    "contacts": ["Contact 1"]
+                }
+            }
 
-    # Scan Products
-    products_dir = base_path / "Products"
-    if products_dir.exists():
-        structure_info.append("\nProducts:")
-        for product_dir in sorted(products_dir.iterdir()):
-            if product_dir.is_dir():
-                structure_info.append(f"  - {product_dir.name}")
-                # Check for reference materials
-                ref_dir = product_dir / "Reference Materials"
-                if ref_dir.exists():
-                    for category_dir in sorted(ref_dir.iterdir()):
-                        if category_dir.is_dir():
-                            structure_info.append(f"      Reference Materials/{category_dir.name}/")
+            %(existing_structure)s
 
-    # Scan Clients
-    clients_dir = base_path / "Clients"
-    if clients_dir.exists():
-        structure_info.append("\nClients:")
-        for client_dir in sorted(clients_dir.iterdir()):
-            if client_dir.is_dir():
-                structure_info.append(f"  - {client_dir.name}")
-                # List existing files
-                files = [f.name for f in client_dir.iterdir() if f.is_file()]
-                if files:
-                    structure_info.append(f"      Files: {', '.join(files)}")
+            DOCUMENT CONTENT:
+            %(sample)s
+            """
 
-    return "\n".join(structure_info)
+_COMBINED_PROMPT = """%(company_context)sAnalyze the document below and extract ALL knowledge base content from it in a single response.
 
+            INSTRUCTIONS:
+            1. **Metadata**
+               - products: Products/systems that are SUBSTANTIALLY discussed (technical details, procedures,
+                 configuration info). EXCLUDE products only mentioned in passing, listed in a table, or used as an example.
+                 If products already exist in the structure below, use EXACT same name.
+               - client_name: The client/customer this document is for - distinguish between our company
+                 (%(company_name)s), the client, and vendors. Use EXACT same name if the client exists in
+                 the structure below. Use null if this is internal documentation.
+               - document_type: e.g. "User Manual", "Technical Specification", "How-To Guide", "Installation Guide"
+               - document_category: e.g. "Version Control", "Controls Systems", "Electrical", "Configuration"
+
+            2. **Products** - for EACH product listed in metadata:
+               - knowledge: A professional wiki article in markdown starting IMMEDIATELY with "## Overview".
+                 Only include sections with actual content: Overview, Features & Capabilities,
+                 Integration & Interfaces, Configuration & Setup, Usage & Operations, Technical Details,
+                 Engineering Notes. If the document has insufficient information about the product, use
+                 exactly "INSUFFICIENT_INFORMATION" instead of an article.
+               - reference_materials: 1-3 reusable knowledge items, each with:
+                 type (DOCUMENT_TEMPLATE, ENGINEERING, HOW_TO, INSTALLATION, CONFIGURATION, SETUP,
+                 PROCEDURE, REFERENCE or BEST_PRACTICES), title, category, content (complete markdown
+                 starting with a # heading, not a summary) and tags (3-5 lowercase, hyphenated tags)
+
+            3. **Client** - if client_name is not null, organize client information into categories:
+               overview (string), locations, hardware, configuration, contacts (lists of strings).
+               You can add additional categories if needed (e.g., "software", "network", "security").
+               Use an empty object if there is no client.
+
+            CRITICAL - WIKI STYLE REQUIREMENTS for all markdown content:
+            - Write DIRECTLY as a wiki article - ABSOLUTELY NO meta-commentary
+            - NEVER say: "after reviewing", "based on the document", "this document", "let me", "I will", etc.
+            - Write in present tense, factual, encyclopedic style
+            - Include tables, lists, code blocks where appropriate
 
-def save_product_knowledge(base_dir: Path, product_name: str, knowledge: str,
-                           reference_materials: list, doc_type: str, doc_category: str, doc_metadata: dict = None):
-    """Save product knowledge and reference materials"""
-    from datetime import datetime
-    import re
+            Return ONLY valid JSON in this exact format:
+            {
+                "metadata": {
+                    "products": ["Product1"],
+                    "client_name": "ClientName or null",
+                    "document_type": "DocumentType",
+                    "document_category": "Category"
+                },
+                "products": {
+                    "Product1": {
+                        "knowledge": "## Overview\\n\\n...",
+                        "reference_materials": [
+                            {
+                                "type": "HOW_TO",
+                                "title": "How to Configure Product1",
+                                "category": "Configuration",
+                                "content": "# How to Configure Product1\\n\\n...",
+                                "tags": ["product1", "configuration"]
+                            }
+                        ]
+                    }
+                },
+                "client": {
+                    "overview": "Brief overview of the client and project",
+                    "locations": ["Location 1 with details"],
+                    "hardware": ["Hardware item 1"],
+                    "configuration": ["Config detail 1"],
+                    "contacts": ["Contact 1"]
+                }
+            }
 
-    product_dir = base_dir / "Products" / product_name
-    product_dir.mkdir(parents=True, exist_ok=True)
+            %(existing_structure)s
 
-    # Save product knowledge with YAML front matter
-    knowledge_file = product_dir / "overview.md"
+            DOCUMENT CONTENT:
+            %(sample)s
+            """
 
-    # Check if file exists and if we should update it
-    should_update = True
-    if knowledge_file.exists() and doc_metadata and doc_metadata.get('modified'):
-        # Read existing file to check last document date
-        try:
-            with open(knowledge_file, 'r', encoding='utf-8') as f:
-                content = f.read()
-                # Extract source_document_modified from YAML
-                match = re.search(r'source_document_modified:\s*"?([^"\n]+)"?', content)
-                if match:
-                    existing_date = match.group(1)
-                    new_date = doc_metadata.get('modified')
-                    if existing_date >= new_date:
-                        print(f"      [SKIP] {knowledge_file.name} - existing article is up-to-date (source: {existing_date})")
-                        should_update = False
-        except Exception:
-            # If error reading existing file, proceed with update
-            pass
 
-    if should_update:
-        with open(knowledge_file, 'w', encoding='utf-8') as f:
-            # YAML front matter
-            f.write("---\n")
-            f.write(f"title: \"{product_name}\"\n")
-            f.write(f"type: \"Product Overview\"\n")
-            f.write(f"product: \"{product_name}\"\n")
-            f.write(f"date_updated: \"{datetime.now().strftime('%Y-%m-%d')}\"\n")
-
-            # Add source document metadata
-            if doc_metadata:
-                if doc_metadata.get('author'):
-                    f.write(f"source_document_author: \"{doc_metadata['author']}\"\n")
-                if doc_metadata.get('modified'):
-                    f.write(f"source_document_modified: \"{doc_metadata['modified']}\"\n")
-                if doc_metadata.get('title'):
-                    f.write(f"source_document_title: \"{doc_metadata['title']}\"\n")
-
-            f.write("---\n\n")
-
-            f.write(f"# {product_name}\n\n")
-            if doc_metadata and doc_metadata.get('modified'):
-                f.write(f"*Source document last modified: {doc_metadata['modified'][:10]}*\n\n")
-            f.write(knowledge)
-        print(f"      [OK] Saved: {knowledge_file}")
-
-    # Save each reference material (guides, templates, procedures, etc.)
-    for ref_material in reference_materials:
-        ref_type = ref_material.get('type', 'REFERENCE')
-        ref_title = ref_material.get('title', doc_type)
-        ref_category = ref_material.get('category', doc_category)
-        ref_content = ref_material.get('content', '')
-        ref_tags = ref_material.get('tags', [])
-
-        # Create safe filename from title
-        safe_filename = "".join(c if c.isalnum() or c in (' ', '-', '_') else '_' for c in ref_title)
-        safe_filename = safe_filename.replace(' ', '_')
-
-        reference_dir = product_dir / "Reference Materials" / ref_category
-        reference_dir.mkdir(parents=True, exist_ok=True)
-        reference_file = reference_dir / f"{safe_filename}.md"
-
-        with open(reference_file, 'w', encoding='utf-8') as f:
-            # YAML front matter
-            f.write("---\n")
-            f.write(f"title: \"{ref_title}\"\n")
-            f.write(f"type: \"{ref_type}\"\n")
-            f.write(f"category: \"{ref_category}\"\n")
-            f.write(f"product: \"{product_name}\"\n")
-            f.write(f"source_document: \"{doc_type}\"\n")
-            f.write(f"date_extracted: \"{datetime.now().strftime('%Y-%m-%d')}\"\n")
-
-            # Add source document metadata
-            if doc_metadata:
-                if doc_metadata.get('author'):
-                    f.write(f"source_document_author: \"{doc_metadata['author']}\"\n")
-                if doc_metadata.get('modified'):
-                    f.write(f"source_document_modified: \"{doc_metadata['modified']}\"\n")
-
-            # Tags as YAML array
-            if ref_tags:
-                f.write("tags:\n")
-                for tag in ref_tags:
-                    f.write(f"  - {tag}\n")
-            else:
-                f.write("tags: []\n")
+# ============================================================================
+# Extraction Functions
+# ============================================================================
 
-            f.write("---\n\n")
+def _render_prompt(template: str, **fields) -> str:
+    """Fill in a prompt template, adding the company fields that every extraction prompt shares"""
+    return template % {"company_context": get_company_context(), "company_name": COMPANY_NAME or 'us', **fields}
 
-            # Content
-            f.write(ref_content)
-        print(f"      [OK] Saved: {reference_file}")
 
+def _build_metadata_prompt(content: str, existing_structure: str) -> str:
+    """Fill in the metadata prompt for a document digest"""
+    return _render_prompt(_METADATA_PROMPT, existing_structure=existing_structure, sample=content)
 
-def save_client_info(base_dir: Path, client_name: str, client_data: dict):
-    """Save client information split into separate files"""
-    from datetime import datetime
 
-    client_dir = base_dir / "Clients" / client_name
-    client_dir.mkdir(parents=True, exist_ok=True)
-
-    date_str = datetime.now().strftime('%Y-%m-%d')
-
-    # Save overview
-    if client_data.get("overview"):
-        with open(client_dir / "overview.md", 'w', encoding='utf-8') as f:
-            f.write("---\n")
-            f.write(f"title: \"{client_name} - Overview\"\n")
-            f.write(f"type: \"Client Overview\"\n")
-            f.write(f"client: \"{client_name}\"\n")
-            f.write(f"date_updated: \"{date_str}\"\n")
-            f.write("---\n\n")
-            f.write(f"# {client_name} - Overview\n\n")
-            f.write(client_data["overview"])
-        print(f"      [OK] Saved: {client_dir / 'overview.md'}")
-
-    # Save locations
-    if client_data.get("locations"):
-        with open(client_dir / "locations.md", 'w', encoding='utf-8') as f:
-            f.write("---\n")
-            f.write(f"title: \"{client_name} - Locations\"\n")
-            f.write(f"type: \"Client Locations\"\n")
-            f.write(f"client: \"{client_name}\"\n")
-            f.write(f"date_updated: \"{date_str}\"\n")
-            f.write("---\n\n")
-            f.write(f"# {client_name} - Locations\n\n")
-            for loc in client_data["locations"]:
-                f.write(f"- {loc}\n")
-        print(f"      [OK] Saved: {client_dir / 'locations.md'}")
-
-    # Save hardware
-    if client_data.get("hardware"):
-        with open(client_dir / "hardware.md", 'w', encoding='utf-8') as f:
-            f.write("---\n")
-            f.write(f"title: \"{client_name} - Hardware\"\n")
-            f.write(f"type: \"Client Hardware\"\n")
-            f.write(f"client: \"{client_name}\"\n")
-            f.write(f"date_updated: \"{date_str}\"\n")
-            f.write("---\n\n")
-            f.write(f"# {client_name} - Hardware\n\n")
-            for hw in client_data["hardware"]:
-                f.write(f"- {hw}\n")
-        print(f"      [OK] Saved: {client_dir / 'hardware.md'}")
-
-    # Save configuration
-    if client_data.get("configuration"):
-        with open(client_dir / "configuration.md", 'w', encoding='utf-8') as f:
-            f.write("---\n")
-            f.write(f"title: \"{client_name} - Configuration\"\n")
-            f.write(f"type: \"Client Configuration\"\n")
-            f.write(f"client: \"{client_name}\"\n")
-            f.write(f"date_updated: \"{date_str}\"\n")
-            f.write("---\n\n")
-            f.write(f"# {client_name} - Configuration\n\n")
-            for cfg in client_data["configuration"]:
-                f.write(f"- {cfg}\n")
-        print(f"      [OK] Saved: {client_dir / 'configuration.md'}")
-
-    # Save contacts
-    if client_data.get("contacts"):
-        with open(client_dir / "contacts.md", 'w', encoding='utf-8') as f:
-            f.write("---\n")
-            f.write(f"title: \"{client_name} - Contacts\"\n")
-            f.write(f"type: \"Client Contacts\"\n")
-            f.write(f"client: \"{client_name}\"\n")
-            f.write(f"date_updated: \"{date_str}\"\n")
-            f.write("---\n\n")
-            f.write(f"# {client_name} - Contacts\n\n")
-            for contact in client_data["contacts"]:
-                f.write(f"- {contact}\n")
-        print(f"      [OK] Saved: {client_dir / 'contacts.md'}")
-
-    # Save any additional dynamic categories
-    for key, value in client_data.items():
-        if key not in ['overview', 'locations', 'hardware', 'configuration', 'contacts']:
-            filename = f"{key}.md"
-            with open(client_dir / filename, 'w', encoding='utf-8') as f:
-                f.write("---\n")
-                f.write(f"title: \"{client_name} - {key.title()}\"\n")
-                f.write(f"type: \"Client {key.title()}\"\n")
-                f.write(f"client: \"{client_name}\"\n")
-                f.write(f"date_updated: \"{date_str}\"\n")
-                f.write("---\n\n")
-                f.write(f"# {client_name} - {key.title()}\n\n")
-                if isinstance(value, list):
-                    for item in value:
-                        f.write(f"- {item}\n")
-                else:
-                    f.write(str(value))
-            print(f"      [OK] Saved: {client_dir / filename}")
+def _build_classification_prompt(products: List[str], content: str, existing_structure: str) -> str:
+    """Fill in the classification prompt for a document digest whose products are known"""
+    return _render_prompt(_CLASSIFICATION_PROMPT, products=", ".join(products),
+                          existing_structure=existing_structure, sample=content)
 
 
-def find_docx_files(directory: str, recursive: bool = False) -> List[Path]:
-    """Find all .docx files in a directory
+def _classified_metadata(products: List[str], classification: DocumentClassification) -> DocumentMetadata:
+    """Metadata for a document from its known products and the model's classification"""
+    return DocumentMetadata(
+        products=products,
+        client_name=classification.client_name,
+        document_type=classification.document_type,
+        document_category=classification.document_category
+    )
 
-    Args:
-        directory: Directory path to scan
-        recursive: If True, scan subdirectories recursively. If False, only scan top-level.
-    """
-    directory_path = Path(directory)
-    if not directory_path.exists():
-        return []
 
-    # Find all .docx files, excluding temporary files (starting with ~$)
-    if recursive:
-        # Recursive scan using rglob
-        docx_files = [
-            f for f in directory_path.rglob("*.docx")
-            if not f.name.startswith("~$")
-        ]
-    else:
-        # Non-recursive scan using glob
-        docx_files = [
-            f for f in directory_path.glob("*.docx")
-            if not f.name.startswith("~$")
-        ]
+def _default_metadata() -> DocumentMetadata:
+    """Metadata for a document with no identifiable products or client"""
+    return DocumentMetadata(
+        products=[],
+        client_name=None,
+        document_type="Unknown",
+        document_category="General"
+    )
 
-    return sorted(docx_files)
 
+def extract_metadata(content: str, client: OpenAI, existing_structure: str,
+                     known_names: List[str] = (), known_products: List[str] = ()) -> DocumentMetadata:
+    """Extract metadata: products mentioned, client name, document type
 
-def process_document(doc_path: str, base_dir: Path, input_dir: str, client: OpenAI) -> bool:
-    """Process a single document and add to knowledge base. Returns True if successful."""
-    try:
+    content is normally the document's metadata sample (see build_metadata_sample).
+    Documents that name nothing (see has_likely_entities, given the product and
+    client names already in the knowledge base) get default metadata without a call.
+    When the products are all known ones (see spot_known_products), the model is
+    only asked for the client, type and category.
+    """
+    if not has_likely_entities(content, known_names):
+        log.info("[SKIP] No product or client names found, skipping metadata extraction\n")
+        return _default_metadata()
+
+    products = spot_known_products(content, known_products, known_names)
+    if products is not None:
+        log.info("[Extracting] Document classification (known products: %s)...", ", ".join(products))
+    else:
+        log.info("[Extracting] Document metadata...")
+
+    try:
+        if products is not None:
+            classification = run_json_extraction(
+                client=client,
+                model=ACTIVE_MODELS["light"],
+                result_type=DocumentClassification,
+                prompt=_build_classification_prompt(products, content, existing_structure),
+                timeout=120,
+                max_tokens=METADATA_MAX_TOKENS
+            )
+            metadata = _classified_metadata(products, classification)
+            log.info("[OK] Found: %d products, Client: %s\n", len(metadata.products), metadata.client_name)
+            return metadata
+
+        metadata = run_json_extraction(
+            client=client,
+            model=ACTIVE_MODELS["light"],
+            result_type=DocumentMetadata,
+            prompt=_build_metadata_prompt(content, existing_structure),
+            timeout=120,
+            max_tokens=METADATA_MAX_TOKENS
+        )
+
+        log.info("[OK] Found: %d products, Client: %s\n", len(metadata.products), metadata.client_name)
+        return metadata
+
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        log.error("[ERROR] Failed to extract metadata: %s", e)
+        log.error("   Details: %s...\n", error_details[:500])
+        return _default_metadata()
+
+
+def extract_metadata_batch(contents: List[str], client: OpenAI, existing_structure: str,
+                           known_names: List[str] = (), known_products: List[str] = ()) -> List[DocumentMetadata]:
+    """Extract metadata for many documents with one Batch API job
+
+    Batch jobs cost less than individual requests but may take hours, so this
+    is only used when asked for (--batch-mode). Responses already in the
+    response cache are reused and only the rest are submitted; each validated
+    answer is cached like a regular extract_metadata result. Documents whose
+    batch answer is missing or invalid, or all of them if the job fails, are
+    extracted individually instead. As in extract_metadata, documents that
+    name nothing get default metadata, and documents whose products are all
+    known ones are only asked for the client, type and category.
+
+    Args:
+        contents: Document metadata samples (see build_metadata_sample)
+        client: OpenAI client
+        existing_structure: Summary of the existing knowledge base structure
+        known_names: Product and client names already in the knowledge base
+        known_products: Product names already in the knowledge base
+
+    Returns:
+        Metadata for each document, in the same order as contents
+    """
+    model = ACTIVE_MODELS["light"]
+    response_format = {"type": "json_object"}
+    results: List[Optional[DocumentMetadata]] = [
+        None if has_likely_entities(content, known_names) else _default_metadata() for content in contents
+    ]
+    # The same prompts extract_metadata would send, so the cached answers are shared
+    spotted = [
+        spot_known_products(content, known_products, known_names) if result is None else None
+        for content, result in zip(contents, results)
+    ]
+    prompts = [
+        _build_metadata_prompt(content, existing_structure) if products is None
+        else _build_classification_prompt(products, content, existing_structure)
+        for content, products in zip(contents, spotted)
+    ]
+    cache_keys = [None] * len(contents)
+
+    def parse(i: int, content: str) -> DocumentMetadata:
+        if spotted[i] is None:
+            return parse_json_response(content, DocumentMetadata)
+        return _classified_metadata(spotted[i], parse_json_response(content, DocumentClassification))
+
+    if LLM_CACHE_DIR:
+        for i, prompt in enumerate(prompts):
+            if results[i] is not None:
+                continue
+            cache_keys[i] = _llm_cache_key(model, prompt, None, response_format)
+            cached = _llm_cache_get(cache_keys[i])
+            if cached is not None:
+                try:
+                    results[i] = parse(i, cached)
+                except (json.JSONDecodeError, msgspec.DecodeError):
+                    pass
+
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending:
+        log.info("[Batch] Submitting metadata extraction for %d document(s)...", len(pending))
+        try:
+            lines = [
+                _dumps({
+                    "custom_id": str(i),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model,
+                        "messages": [{"role": "user", "content": prompts[i]}],
+                        "temperature": 1,  # Kimi K2.5 requires temperature=1
+                        "response_format": response_format,
+                        "max_tokens": METADATA_MAX_TOKENS,
+                    },
+                })
+                for i in pending
+            ]
+            batch_file = client.files.create(
+                file=("metadata_batch.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch"
+            )
+            batch = client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            log.info("[Batch] Job %s submitted, checking every %ss", batch.id, BATCH_POLL_INTERVAL)
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                time.sleep(BATCH_POLL_INTERVAL)
+                batch = client.batches.retrieve(batch.id)
+            log.info("[Batch] Job %s %s", batch.id, batch.status)
+
+            if batch.output_file_id:
+                for line in client.files.content(batch.output_file_id).text.splitlines():
+                    if not line.strip():
+                        continue
+                    try:
+                        record = _loads(line)
+                        i = int(record["custom_id"])
+                        content = record["response"]["body"]["choices"][0]["message"]["content"]
+                        results[i] = parse(i, content)
+                    except (KeyError, IndexError, TypeError, ValueError, msgspec.DecodeError):
+                        continue
+                    if cache_keys[i]:
+                        _llm_cache_put(cache_keys[i], model, content)
+        except Exception as e:
+            log.error("[ERROR] Batch metadata extraction failed: %s", e)
+
+    for i, result in enumerate(results):
+        if result is None:
+            results[i] = extract_metadata(contents[i], client, existing_structure, known_names, known_products)
+    return results
+
+
+def extract_product_knowledge(product_name: str, doc_data: dict, client: OpenAI, existing_structure: str) -> str:
+    """Extract knowledge about a specific product using tool-based retrieval"""
+    log.info("   [Product] Extracting knowledge for: %s", product_name)
+
+    if _is_insufficient(product_name, doc_data):
+        log.info("   [SKIP] %s is only mentioned in passing, not asking the model\n", product_name)
+        return "INSUFFICIENT_INFORMATION"
+
+    # Structure summary for the AI (built once per document, shared by all products)
+    structure_summary = get_structure_summary(doc_data)
+
+    # Make the document available to the retrieval tools for this call only
+    document_token = _current_document.set(doc_data)
+    try:
+        # With KB_CACHE_DIR set, a document whose sections about the product were all
+        # seen before, or a near-duplicate of a document already processed (e.g. a
+        # re-issued copy with small edits), reuses that earlier article. Articles are
+        # stored under the model that wrote them, so both tier models are checked.
+        sketch = None
+        if LLM_CACHE_DIR:
+            models = [ACTIVE_MODELS["heavy"]]
+            if ACTIVE_MODELS["escalate"] and ACTIVE_MODELS["escalate"] not in models:
+                models.append(ACTIVE_MODELS["escalate"])
+            for model in models:
+                sections_key = _product_sections_key(product_name, doc_data, model)
+                cached = _llm_cache_get(sections_key) if sections_key else None
+                if cached is not None:
+                    log.info("   [CACHE] Reusing knowledge from identical sections about %s (%d characters)\n",
+                             product_name, len(cached))
+                    return cached
+
+            sketch = _document_sketch(doc_data)
+            for model in models:
+                cached = _near_duplicate_get("\x00".join([product_name, model, PROMPT_VERSION]), sketch)
+                if cached is not None:
+                    log.info("   [CACHE] Reusing knowledge from a near-duplicate document (%d characters)\n",
+                             len(cached))
+                    return cached
+
+        prompt = _render_prompt(
+            _PRODUCT_KNOWLEDGE_PROMPT,
+            product_name=product_name,
+            existing_structure=existing_structure,
+            structure_summary=structure_summary
+        )
+        answered_by = None
+
+        def run(model: str) -> str:
+            # The last model run is the one whose article run_with_escalation returns
+            nonlocal answered_by
+            answered_by = model
+            return run_with_tools(
+                client=client,
+                model=model,
+                prompt=prompt,
+                functions=DOCUMENT_TOOLS,
+                return_type=str,
+                timeout=300
+            )
+
+        result = run_with_escalation(run, _has_enough_knowledge)
+
+        if sketch is not None and result and _has_enough_knowledge(result):
+            sections_key = _product_sections_key(product_name, doc_data, answered_by)
+            if sections_key:
+                _llm_cache_put(sections_key, answered_by, result)
+            _near_duplicate_put("\x00".join([product_name, answered_by, PROMPT_VERSION]), sketch, result)
+        log.info("   [OK] Extracted %d characters of knowledge\n", len(result))
+        return result
+
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        log.error("   [ERROR] Failed to extract product knowledge: %s", e)
+        log.error("   Details: %s...\n", error_details[:500])
+        return f"# {product_name}\n\nError extracting knowledge: {e}\n\nDetails:\n{error_details}"
+
+    finally:
+        # Always restore the previous document
+        _current_document.reset(document_token)
+
+
+def extract_document_template(product_name: str, doc_data: dict, client: OpenAI, existing_structure: str) -> List[ReferenceMaterial]:
+    """Extract reusable reference materials from document using tool-based retrieval"""
+    log.info("   [Analyzing] Document for reusable reference materials: %s", product_name)
+
+    # Structure summary for the AI (built once per document, shared by all products)
+    structure_summary = get_structure_summary(doc_data)
+
+    # Make the document available to the retrieval tools for this call only
+    document_token = _current_document.set(doc_data)
+    try:
+        prompt = _render_prompt(
+            _REFERENCE_MATERIALS_PROMPT,
+            existing_structure=existing_structure,
+            structure_summary=structure_summary,
+            product_name=product_name
+        )
+        result = run_with_escalation(
+            lambda model: run_json_extraction(
+                client=client,
+                model=model,
+                result_type=List[ReferenceMaterial],
+                prompt=prompt,
+                functions=DOCUMENT_TOOLS,
+                timeout=300,
+                json_mode=False  # JSON mode only allows objects; this returns an array
+            )
+        )
+
+        log.info("   [OK] Identified %d reference material(s)\n", len(result))
+        return result
+
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        log.error("   [ERROR] Failed to extract reference materials: %s", e)
+        log.error("   Details: %s...", error_details[:500])
+        return []
+
+    finally:
+        # Always restore the previous document
+        _current_document.reset(document_token)
+
+
+def share_budget(texts: List[str], limit: int) -> str:
+    """Join texts, cutting each so that together they fit in limit characters
+
+    Every text gets an equal share of the budget; what a shorter text leaves
+    unused goes to the longer ones, so nothing is cut that could have fit.
+
+    Args:
+        texts: Texts to join, e.g. the digests of a client's documents
+        limit: Maximum length of the result in characters
+
+    Returns:
+        The texts, each cut to its share, separated by blank lines
+    """
+    remaining = limit - 2 * (len(texts) - 1)
+    parts = [""] * len(texts)
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    for done, i in enumerate(order):
+        parts[i] = texts[i][:max(remaining, 0) // (len(texts) - done)]
+        remaining -= len(parts[i])
+    return "\n\n".join(parts)
+
+
+def extract_client_info(client_name: str, content: str, client: OpenAI, existing_structure: str) -> ClientInfo:
+    """Extract client information split into categories
+
+    content is sent whole; keep it within CLIENT_CONTENT_CHARS (see share_budget).
+    """
+    # Skip if no valid client name
+    if not client_name or client_name.lower() in ['none', 'unknown', 'n/a']:
+        return {}
+
+    log.info("   [Client] Extracting information for: %s", client_name)
+
+    try:
+        client_data = drop_empty_categories(run_json_extraction(
+            client=client,
+            model=ACTIVE_MODELS["light"],
+            result_type=ClientInfo,
+            prompt=_render_prompt(
+                _CLIENT_INFO_PROMPT,
+                client_name=client_name,
+                existing_structure=existing_structure,
+                sample=content
+            ),
+            timeout=120
+        ))
+
+        log.info("   [OK] Extracted %d categories\n", len(client_data))
+        return client_data
+
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        log.error("   [ERROR] Failed to extract client info: %s", e)
+        log.error("   Details: %s...\n", error_details[:500])
+        return {}
+
+
+def extract_metadata_and_client(content: str, client: OpenAI, existing_structure: str,
+                                known_names: List[str] = ()) -> Optional[MetadataAndClient]:
+    """Extract metadata and client information in one call
+
+    content is normally the document's metadata sample (see build_metadata_sample),
+    which also holds the lines naming the client, so one short prompt replaces
+    separate extract_metadata() and extract_client_info() calls.
+
+    Returns:
+        MetadataAndClient with the metadata and the client info (None without a client),
+        or None if the response could not be parsed, in which case the caller should
+        fall back to extract_metadata() and extract_client_info().
+    """
+    if not has_likely_entities(content, known_names):
+        log.info("[SKIP] No product or client names found, skipping metadata extraction\n")
+        return MetadataAndClient(metadata=_default_metadata())
+
+    log.info("[Extracting] Document metadata and client info...")
+
+    try:
+        result = run_json_extraction(
+            client=client,
+            model=ACTIVE_MODELS["light"],
+            result_type=MetadataAndClient,
+            prompt=_render_prompt(
+                _METADATA_AND_CLIENT_PROMPT,
+                existing_structure=existing_structure,
+                sample=content
+            ),
+            timeout=120,
+            max_tokens=METADATA_AND_CLIENT_MAX_TOKENS
+        )
+        if result.client is not None:
+            result.client = drop_empty_categories(result.client)
+
+        log.info("[OK] Found: %d products, Client: %s\n", len(result.metadata.products), result.metadata.client_name)
+        return result
+
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        log.error("[ERROR] Failed to extract metadata and client info, falling back to separate passes: %s", e)
+        log.error("   Details: %s...\n", error_details[:500])
+        return None
+
+
+def extract_all(content: str, client: OpenAI, existing_structure: str) -> Optional[CombinedExtraction]:
+    """Extract metadata, product knowledge, reference materials and client info in one call
+
+    Only used when asked for (--combined). Runs on the heavy model, escalating like
+    the other heavy extractions (see run_with_escalation).
+
+    Returns:
+        CombinedExtraction with the metadata, per-product results and client info,
+        or None if the combined response could not be parsed, in which case the
+        caller should fall back to the individual extraction passes.
+    """
+    log.info("[Extracting] Metadata, product knowledge, reference materials and client info...")
+
+    sample = content[:30000]
+
+    prompt = _render_prompt(_COMBINED_PROMPT, existing_structure=existing_structure, sample=sample)
+    try:
+        combined = run_with_escalation(
+            lambda model: run_json_extraction(
+                client=client,
+                model=model,
+                result_type=CombinedExtraction,
+                prompt=prompt,
+                timeout=300
+            )
+        )
+
+        if combined.client is not None:
+            combined.client = drop_empty_categories(combined.client)
+
+        log.info("[OK] Found: %d products, Client: %s\n", len(combined.metadata.products), combined.metadata.client_name)
+        return combined
+
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        log.error("[ERROR] Failed to extract combined response, falling back to individual passes: %s", e)
+        log.error("   Details: %s...\n", error_details[:500])
+        return None
+
+
+# ============================================================================
+# File Saving Functions
+# ============================================================================
+
+# Cached result of _scan_structure, keyed by the knowledge base directory mtimes
+_structure_cache = {"key": None, "data": None, "generation": 0}
+_structure_cache_lock = threading.Lock()
+
+EMPTY_STRUCTURE = "EXISTING KNOWLEDGE BASE STRUCTURE: Empty (this is the first document)"
+
+
+def _structure_cache_key(base_path: str) -> tuple:
+    """Build the cache key for a knowledge base: its path plus the mtimes of the top-level directories
+
+    The knowledge base's own mtime is None when it doesn't exist.
+    """
+    key = [os.path.abspath(base_path)]
+    for path in (base_path, os.path.join(base_path, "Products"), os.path.join(base_path, "Clients")):
+        try:
+            key.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            key.append(None)
+    return tuple(key)
+
+
+def invalidate_structure_cache():
+    """Forget the cached knowledge base structure (call after writing to the knowledge base)"""
+    with _structure_cache_lock:
+        _structure_cache["key"] = None
+        _structure_cache["data"] = None
+        _structure_cache["generation"] += 1
+
+
+def _add_sorted(names: list, name: str) -> list:
+    """Return a copy of a sorted name list with name added, or the list itself if already present"""
+    if name in names:
+        return names
+    names = list(names)
+    bisect.insort(names, name)
+    return names
+
+
+def _fold_structure_writes(data: dict, base_path: Path, paths: List[Path]) -> dict:
+    """Return a copy of a cached structure scan with the files at paths added
+
+    Copy on write: readers may be iterating over the cached dicts.
+    """
+    products = dict(data["products"] or {})
+    clients = dict(data["clients"] or {})
+    for path in paths:
+        parts = path.relative_to(base_path).parts
+        if len(parts) < 3:
+            continue
+        if parts[0] == "Products":
+            categories = products.get(parts[1], [])
+            if len(parts) >= 5 and parts[2] == "Reference Materials":
+                categories = _add_sorted(categories, parts[3])
+            products[parts[1]] = categories
+        elif parts[0] == "Clients":
+            files = clients.get(parts[1], [])
+            if len(parts) == 3:
+                files = _add_sorted(files, parts[2])
+            clients[parts[1]] = files
+
+    return {
+        "products": dict(sorted(products.items())) if products or data["products"] is not None else None,
+        "clients": dict(sorted(clients.items())) if clients or data["clients"] is not None else None,
+    }
+
+
+def record_structure_writes(base_dir: Path, paths: List[Path]):
+    """Fold files just written to the knowledge base into the cached structure
+
+    Saves only ever add products, reference categories, clients and client files,
+    so the cached scan is updated in memory instead of being thrown away and the
+    whole knowledge base rescanned for the next document. Falls back to
+    invalidate_structure_cache() when there is no cached scan of base_dir.
+    """
+    base_path = Path(base_dir)
+    with _structure_cache_lock:
+        cached_key, data = _structure_cache["key"], _structure_cache["data"]
+        if data is not None and cached_key[0] == os.path.abspath(base_path):
+            # Any scan running now started before these writes, so it must not be cached
+            _structure_cache["generation"] += 1
+            _structure_cache["data"] = _fold_structure_writes(data, base_path, paths)
+            _structure_cache["key"] = _structure_cache_key(os.fspath(base_path))
+            return
+
+    invalidate_structure_cache()
+
+
+def _scan_entries(directory) -> Optional[List[os.DirEntry]]:
+    """List a directory's entries sorted by name, or None if it doesn't exist
+
+    os.scandir caches each entry's file type, so the is_dir()/is_file()
+    checks that follow don't need a stat call per entry.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return sorted(it, key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return None
+
+
+def _scan_structure(base_dir: str) -> Optional[dict]:
+    """Scan the knowledge base into {"products": {name: [categories]}, "clients": {name: [files]}}
+
+    "products"/"clients" are None when the directory doesn't exist, and the whole
+    result is None when the knowledge base doesn't exist yet. The result is cached
+    and reused until the knowledge base directories change; saves update it in
+    place through record_structure_writes().
+    """
+    base_path = os.fspath(base_dir)
+    cache_key = _structure_cache_key(base_path)
+    if cache_key[1] is None:
+        return None
+
+    with _structure_cache_lock:
+        if _structure_cache["key"] == cache_key:
+            return _structure_cache["data"]
+        generation = _structure_cache["generation"]
+
+    data = {"products": None, "clients": None}
+
+    # Scan Products
+    product_entries = _scan_entries(os.path.join(base_path, "Products"))
+    if product_entries is not None:
+        data["products"] = {}
+        for product_entry in product_entries:
+            if product_entry.is_dir():
+                # Check for reference materials
+                data["products"][product_entry.name] = [
+                    category_entry.name
+                    for category_entry in _scan_entries(os.path.join(product_entry.path, "Reference Materials")) or []
+                    if category_entry.is_dir()
+                ]
+
+    # Scan Clients
+    client_entries = _scan_entries(os.path.join(base_path, "Clients"))
+    if client_entries is not None:
+        data["clients"] = {}
+        for client_entry in client_entries:
+            if client_entry.is_dir():
+                # List existing files
+                data["clients"][client_entry.name] = [
+                    entry.name for entry in _scan_entries(client_entry.path) or [] if entry.is_file()
+                ]
+
+    with _structure_cache_lock:
+        # Don't cache a scan that raced with a save
+        if _structure_cache["generation"] == generation:
+            _structure_cache["key"] = cache_key
+            _structure_cache["data"] = data
+    return data
+
+
+def scan_existing_structure(base_dir: str) -> str:
+    """Describe the full existing knowledge base structure to help AI maintain consistency
+
+    Used where the extractor needs every product, reference category and client file.
+    """
+    data = _scan_structure(base_dir)
+    if data is None:
+        return EMPTY_STRUCTURE
+
+    buf = io.StringIO()
+    buf.write("EXISTING KNOWLEDGE BASE STRUCTURE:")
+
+    if data["products"] is not None:
+        buf.write("\n\nProducts:")
+        for product, categories in data["products"].items():
+            buf.write(f"\n  - {product}")
+            for category in categories:
+                buf.write(f"\n      Reference Materials/{category}/")
+
+    if data["clients"] is not None:
+        buf.write("\n\nClients:")
+        for client_name, files in data["clients"].items():
+            buf.write(f"\n  - {client_name}")
+            if files:
+                buf.write(f"\n      Files: {', '.join(files)}")
+
+    return buf.getvalue()
+
+
+def summarize_existing_structure(base_dir: str) -> str:
+    """Describe the knowledge base as counts and top-level names only
+
+    Enough for the metadata and client extractors to reuse existing product
+    and client names, at a fraction of the size of the full structure.
+    """
+    data = _scan_structure(base_dir)
+    if data is None:
+        return EMPTY_STRUCTURE
+
+    products = data["products"] or {}
+    clients = data["clients"] or {}
+    lines = [f"EXISTING KNOWLEDGE BASE STRUCTURE: {len(products)} product(s), {len(clients)} client(s)"]
+    if products:
+        lines.append(f"Products: {', '.join(products)}")
+    if clients:
+        lines.append(f"Clients: {', '.join(clients)}")
+    return "\n".join(lines)
+
+
+def known_entity_names(base_dir: str) -> List[str]:
+    """Names of the products and clients already in the knowledge base"""
+    data = _scan_structure(base_dir)
+    if data is None:
+        return []
+    return list(data["products"] or {}) + list(data["clients"] or {})
+
+
+def known_product_names(base_dir: str) -> List[str]:
+    """Names of the products already in the knowledge base"""
+    data = _scan_structure(base_dir)
+    if data is None:
+        return []
+    return list(data["products"] or {})
+
+
+def product_existing_structure(base_dir: str, product_name: str) -> str:
+    """Describe the knowledge base subtree for one product
+
+    Lists the product's existing reference categories plus the category names
+    in use across the knowledge base, so new materials are filed consistently.
+    """
+    data = _scan_structure(base_dir)
+    if data is None:
+        return EMPTY_STRUCTURE
+
+    products = data["products"] or {}
+    lines = ["EXISTING KNOWLEDGE BASE STRUCTURE:", "", "Products:"]
+    if product_name in products:
+        lines.append(f"  - {product_name}")
+        lines.extend(f"      Reference Materials/{category}/" for category in products[product_name])
+    else:
+        lines.append(f"  ({product_name} is not in the knowledge base yet)")
+
+    all_categories = sorted({category for categories in products.values() for category in categories})
+    if all_categories:
+        lines.append("")
+        lines.append(f"Reference material categories in use: {', '.join(all_categories)}")
+    return "\n".join(lines)
+
+
+# Content hashes of the files written to each knowledge base, persisted as MANIFEST_NAME.
+# write_files() only updates the in-memory manifest; flush_manifests() saves the changed
+# ones once per document (a stale manifest on disk only means an unchanged file is rewritten)
+MANIFEST_NAME = ".kb_manifest.json"
+_manifests = {}
+_dirty_manifests: Dict[str, Path] = {}
+_manifest_lock = threading.Lock()
+
+
+# Small-file writes overlap on one pool shared by every save, so worker threads
+# are started once per run rather than once per write_files() call
+FILE_WRITE_WORKERS = 4
+_write_pool = ThreadPoolExecutor(max_workers=FILE_WRITE_WORKERS, thread_name_prefix="kb-write")
+
+# Directories already created (or found to exist) during this run
+_known_dirs = set()
+
+
+def _ensure_dir(directory: Path):
+    """mkdir -p a directory, at most once per run"""
+    key = str(directory)
+    if key not in _known_dirs:
+        directory.mkdir(parents=True, exist_ok=True)
+        _known_dirs.add(key)
+
+
+def _content_hash(data: bytes) -> str:
+    """Hash encoded file content for change detection (not for security)"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _write_bytes(path: Path, data: bytes):
+    """Write a file with os.write on a raw descriptor, skipping Python's buffered text layer"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _load_manifest(base_dir: Path) -> dict:
+    """Return the {relative path: content hash} manifest for a knowledge base (call with _manifest_lock held)"""
+    key = str(base_dir.resolve())
+    if key not in _manifests:
+        try:
+            with open(base_dir / MANIFEST_NAME, 'r', encoding='utf-8') as f:
+                _manifests[key] = json.load(f)
+        except (OSError, ValueError):
+            _manifests[key] = {}
+    return _manifests[key]
+
+
+def write_files(base_dir: Path, files: Iterable[tuple]) -> List[Path]:
+    """Write a batch of files, skipping any whose content is unchanged since the last write
+
+    The files are consumed one at a time: each is encoded and handed to the shared
+    write pool as it arrives, so only the pages still waiting to be written are
+    held in memory. Parent directories are created once per run (see _ensure_dir).
+
+    Args:
+        base_dir: Knowledge base directory holding the manifest
+        files: (path, content) pairs, e.g. a generator building each page on demand
+
+    Returns:
+        Paths of the files written
+    """
+    changed = []
+    for path, content in files:
+        relative = path.relative_to(base_dir).as_posix()
+        data = content.encode('utf-8')
+        digest = _content_hash(data)
+        with _manifest_lock:
+            unchanged = _load_manifest(base_dir).get(relative) == digest
+        if unchanged and path.exists():
+            print(f"      [SKIP] {path.name} - unchanged")
+            continue
+        _ensure_dir(path.parent)
+        changed.append((path, relative, digest, _write_pool.submit(_write_bytes, path, data)))
+
+    if not changed:
+        return []
+
+    for path, _, _, future in changed:
+        future.result()
+        print(f"      [OK] Saved: {path}")
+
+    with _manifest_lock:
+        manifest = _load_manifest(base_dir)
+        for _, relative, digest, _ in changed:
+            manifest[relative] = digest
+        _dirty_manifests[str(base_dir.resolve())] = base_dir
+
+    return [path for path, *_ in changed]
+
+
+def flush_manifests():
+    """Save the manifests changed by write_files() since the last flush"""
+    with _manifest_lock:
+        for key, base_dir in _dirty_manifests.items():
+            with open(base_dir / MANIFEST_NAME, 'w', encoding='utf-8') as f:
+                json.dump(_manifests[key], f, indent=2, sort_keys=True)
+        _dirty_manifests.clear()
+
+
+atexit.register(flush_manifests)
+
+
+def _yaml_front_matter(fields: dict) -> str:
+    """Build a page's YAML front matter block
+
+    Values are written as quoted strings and lists as block sequences ("[]" when
+    empty); fields whose value is None are left out.
+    """
+    parts = ["---\n"]
+    for key, value in fields.items():
+        if value is None:
+            continue
+        if isinstance(value, list):
+            if value:
+                parts.append(f"{key}:\n")
+                parts.extend(f"  - {item}\n" for item in value)
+            else:
+                parts.append(f"{key}: []\n")
+        else:
+            parts.append(f"{key}: \"{value}\"\n")
+    parts.append("---\n\n")
+    return "".join(parts)
+
+
+# source_document_modified recorded in each overview.md read or written during this run
+# (None when the article has none), so later documents for the product skip the file
+_overview_sources: Dict[str, Optional[str]] = {}
+
+
+def _is_not_older(existing_date: str, new_date: str) -> bool:
+    """Compare two source document timestamps, falling back to comparing the strings"""
+    try:
+        return datetime.datetime.fromisoformat(existing_date) >= datetime.datetime.fromisoformat(new_date)
+    except (ValueError, TypeError):
+        return existing_date >= new_date
+
+
+def _is_up_to_date(knowledge_file: Path, new_date: str) -> bool:
+    """Check whether an existing article was built from a source at least as new as new_date
+
+    new_date is the source document's modified timestamp (ISO 8601 UTC). Articles
+    seen earlier in the run are answered from _overview_sources. Otherwise an article
+    last written before that moment cannot record it, so it is outdated without being
+    read; failing that only the start of the file holding the YAML front matter is read.
+    Without a new_date there is nothing to compare, and the article is never opened.
+    """
+    if not new_date:
+        return False
+
+    key = str(knowledge_file)
+    if key in _overview_sources:
+        existing_date = _overview_sources[key]
+    else:
+        try:
+            article_mtime = os.stat(knowledge_file).st_mtime
+        except OSError:
+            return False
+
+        try:
+            modified = datetime.datetime.fromisoformat(new_date).replace(tzinfo=datetime.timezone.utc)
+            if article_mtime < modified.timestamp():
+                return False
+        except ValueError:
+            pass
+
+        try:
+            with open(knowledge_file, 'rb') as f:
+                head = f.read(FRONT_MATTER_READ_BYTES).decode('utf-8', 'ignore')
+        except OSError:
+            # If error reading existing file, proceed with update
+            return False
+
+        # Extract source_document_modified from YAML
+        match = _SOURCE_MODIFIED_RE.search(head)
+        existing_date = match.group(1) if match else None
+        _overview_sources[key] = existing_date
+
+    if existing_date and _is_not_older(existing_date, new_date):
+        print(f"      [SKIP] {knowledge_file.name} - existing article is up-to-date (source: {existing_date})")
+        return True
+    return False
+
+
+def save_product_knowledge(base_dir: Path, product_name: str, knowledge: str,
+                           reference_materials: Iterable[ReferenceMaterial], doc_type: str, doc_category: str,
+                           doc_metadata: dict = None, date_str: Optional[str] = None):
+    """Save product knowledge and reference materials
+
+    The pages are built one at a time as write_files consumes them, so reference
+    materials may be any iterable. date_str is the YYYY-MM-DD date stamped on the
+    pages, today's date when not given.
+    """
+    date_str = date_str or datetime.datetime.now().strftime('%Y-%m-%d')
+    product_dir = base_dir / "Products" / product_name
+
+    # Source document metadata, left out of the front matter when missing
+    source = doc_metadata or {}
+    source_author = source.get('author') or None
+    source_modified = source.get('modified') or None
+    source_title = source.get('title') or None
+
+    # Save product knowledge with YAML front matter
+    knowledge_file = product_dir / "overview.md"
+
+    # Check if the existing article is up to date (only possible when the source has a modified date)
+    should_update = not _is_up_to_date(knowledge_file, source_modified)
+
+    def pages() -> Iterator[tuple]:
+        if should_update:
+            front_matter = _yaml_front_matter({
+                "title": product_name,
+                "type": "Product Overview",
+                "product": product_name,
+                "date_updated": date_str,
+                "source_document_author": source_author,
+                "source_document_modified": source_modified,
+                "source_document_title": source_title,
+            })
+            source_note = f"*Source document last modified: {source_modified[:10]}*\n\n" if source_modified else ""
+            yield knowledge_file, f"{front_matter}# {product_name}\n\n{source_note}{knowledge}"
+
+        # Save each reference material (guides, templates, procedures, etc.)
+        for ref_material in reference_materials:
+            ref_title = ref_material.title or doc_type
+            ref_category = ref_material.category or doc_category
+
+            # Create safe filename from title
+            safe_filename = ref_title.translate(_FILENAME_TABLE)
+
+            reference_file = product_dir / "Reference Materials" / ref_category / f"{safe_filename}.md"
+
+            front_matter = _yaml_front_matter({
+                "title": ref_title,
+                "type": ref_material.type or 'REFERENCE',
+                "category": ref_category,
+                "product": product_name,
+                "source_document": doc_type,
+                "date_extracted": date_str,
+                "source_document_author": source_author,
+                "source_document_modified": source_modified,
+                "tags": ref_material.tags,
+            })
+            yield reference_file, front_matter + ref_material.content
+
+    _ensure_dir(product_dir)
+    written = write_files(base_dir, pages())
+    if should_update:
+        _overview_sources[str(knowledge_file)] = source_modified
+    if written:
+        record_structure_writes(base_dir, written)
+
+
+def _client_section_file(client_dir: Path, client_name: str, key: str, value: Union[str, List[str]],
+                         date_str: str) -> tuple:
+    """Build the (path, content) pair for one client category: lists become bullet points"""
+    if isinstance(value, list):
+        body = "".join(f"- {item}\n" for item in value)
+    else:
+        body = str(value)
+    title = key.title()
+    front_matter = _yaml_front_matter({
+        "title": f"{client_name} - {title}",
+        "type": f"Client {title}",
+        "client": client_name,
+        "date_updated": date_str,
+    })
+    return client_dir / f"{key}.md", f"{front_matter}# {client_name} - {title}\n\n{body}"
+
+
+def save_client_info(base_dir: Path, client_name: str, client_data: ClientInfo, date_str: Optional[str] = None):
+    """Save client information split into separate files
+
+    date_str is the YYYY-MM-DD date stamped on the pages, today's date when not given.
+    """
+    date_str = date_str or datetime.datetime.now().strftime('%Y-%m-%d')
+    client_dir = base_dir / "Clients" / client_name
+    files = []
+
+    # The standard categories first (when not empty), then any additional ones the model added
+    for key in CLIENT_CATEGORIES:
+        value = client_data.get(key)
+        if value:
+            files.append(_client_section_file(client_dir, client_name, key, value, date_str))
+    for key, value in client_data.items():
+        if key not in _CLIENT_CATEGORY_SET:
+            files.append(_client_section_file(client_dir, client_name, key, value, date_str))
+
+    _ensure_dir(client_dir)
+    written = write_files(base_dir, files)
+    if written:
+        record_structure_writes(base_dir, written)
+
+
+def _iter_docx(directory: str, recursive: bool) -> Iterator[os.DirEntry]:
+    """Yield the .docx entries of a directory as they are listed, skipping temporary files (~$...)
+
+    Only entry names are checked before the (usually cached) file type, so no extra
+    stat call is made per file. Subdirectories are walked with an explicit stack
+    when recursive, without following symlinks.
+    """
+    stack = [directory]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.endswith(".docx") and not name.startswith("~$") and entry.is_file():
+                    yield entry
+                elif recursive and entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+
+
+def find_docx_files(directory: str, recursive: bool = False) -> List[Path]:
+    """Find all .docx files in a directory
+
+    Args:
+        directory: Directory path to scan
+        recursive: If True, scan subdirectories recursively. If False, only scan top-level.
+
+    Returns:
+        The files sorted by path, directory by directory
+    """
+    if not os.path.isdir(directory):
+        return []
+
+    # Sorting on the split path strings orders the files like sorting the Path objects would
+    entries = sorted(_iter_docx(directory, recursive), key=lambda entry: entry.path.split(os.sep))
+    return [Path(entry.path) for entry in entries]
+
+
+def gather_products(executor: ThreadPoolExecutor, products: List[str], doc_data: dict, client: OpenAI,
+                    input_dir: str) -> Dict[str, tuple]:
+    """Start the knowledge and reference material passes for every product at once
+
+    The passes only wait on the API, so they run side by side on the executor
+    (bounded by its size and the request semaphore) instead of queueing up
+    product by product.
+
+    Args:
+        executor: Executor to run the passes on
+        products: Product names found in the document
+        doc_data: Document data returned by extract_document_structure
+        client: OpenAI client
+        input_dir: Knowledge base directory scanned for each product's existing structure
+
+    Returns:
+        Dict mapping each product to its (knowledge, reference materials) futures
+    """
+    futures = {}
+    for product in products:
+        product_structure = product_existing_structure(input_dir, product)
+        futures[product] = (
+            executor.submit(contextvars.copy_context().run,
+                            extract_product_knowledge, product, doc_data, client, product_structure),
+            executor.submit(contextvars.copy_context().run,
+                            extract_document_template, product, doc_data, client, product_structure),
+        )
+    return futures
+
+
+def process_document(doc_path: str, base_dir: Path, input_dir: str, client: OpenAI,
+                     use_combined: bool = False) -> bool:
+    """Process a single document and add to knowledge base. Returns True if successful.
+
+    By default the metadata is extracted first with the light model, then each
+    product and the client with their own passes. With use_combined, one heavy-model
+    call given the full knowledge base structure extracts everything instead,
+    falling back to the individual passes if its response can't be parsed.
+    """
+    try:
         print("\n" + "=" * 70)
         print(f"[Document] Processing: {Path(doc_path).name}")
         print("=" * 70)
+        date_str = datetime.datetime.now().strftime('%Y-%m-%d')
 
-        # Scan existing structure from input directory
-        existing_structure = scan_existing_structure(input_dir)
+        # Scan existing structure from input directory: the summary is enough for metadata and
+        # client extraction, product extraction gets the product's own subtree
+        structure_summary = summarize_existing_structure(input_dir)
 
         # Extract document structure
         try:
             doc_data = extract_document_structure(doc_path)
-            content = doc_data["full_content"]  # For backward compatibility with metadata extraction
+            content = skim_document(doc_data)  # Digest of the informative parts for content-based extractors
+            sample = build_metadata_sample(doc_data)  # Much smaller sample for the metadata passes
             doc_metadata = doc_data.get("metadata", {})  # Get document metadata
         except Exception as e:
             print(f"[ERROR] Error reading document: {e}")
             return False
 
-        # Extract metadata (products, client, type, category)
-        metadata = extract_metadata(content, client, existing_structure)
-        products = metadata.get("products", [])
-        client_name = metadata.get("client_name", "Unknown")
-        doc_type = metadata.get("document_type", "Specification")
-        doc_category = metadata.get("document_category", "General")
+        # A document that names no product or client has nothing to extract, so no model call is made
+        known_names = known_entity_names(input_dir)
+        if not has_likely_entities(sample, known_names):
+            print("[SKIP] No product or client names found, nothing to extract")
+            print(f"\n[SUCCESS] Completed: {Path(doc_path).name}")
+            return True
+
+        # Optionally extract everything in a single call; None means use the individual passes
+        combined = None
+        if use_combined:
+            combined = extract_all(content, client, scan_existing_structure(input_dir))
+
+        # Extract metadata (products, client, type, category) from the sample. When the lexicon
+        # can't settle the products, the client info is asked for in the same call.
+        fused = None
+        if combined is not None:
+            metadata = combined.metadata
+        else:
+            known_products = known_product_names(input_dir)
+            if spot_known_products(sample, known_products, known_names) is None:
+                fused = extract_metadata_and_client(sample, client, structure_summary, known_names)
+            if fused is not None:
+                metadata = fused.metadata
+            else:
+                metadata = extract_metadata(sample, client, structure_summary, known_names, known_products)
+        products = metadata.products
+        client_name = metadata.client_name
+        doc_type = metadata.document_type
+        doc_category = metadata.document_category
 
         print(f"[Analysis] Document Analysis:")
         print(f"   Products: {', '.join(products)}")
@@ -1276,32 +3311,75 @@ def process_document(doc_path: str, base_dir: Path, input_dir: str, client: Open
         print(f"   Type: {doc_type}")
         print(f"   Category: {doc_category}\n")
 
-        # Process each product
-        for product in products:
-            print(f"[Processing] Product: {product}")
-
-            # Extract product knowledge
-            knowledge = extract_product_knowledge(product, doc_data, client, existing_structure)
+        has_client = client_name and client_name.lower() not in ['none', 'unknown', 'n/a']
 
-            # Check if there's sufficient information
-            if knowledge and "INSUFFICIENT_INFORMATION" in knowledge:
-                print(f"   [SKIP] {product} - insufficient information in document\n")
-                continue
-
-            # Extract reference materials (guides, templates, procedures, etc.)
-            reference_materials = extract_document_template(product, doc_data, client, existing_structure)
-
-            # Save everything with document metadata
-            print(f"   [Saving] Files for {product}...")
-            save_product_knowledge(base_dir, product, knowledge, reference_materials, doc_type, doc_category, doc_metadata)
-
-        # Extract and save client information
-        if client_name and client_name.lower() not in ['none', 'unknown', 'n/a']:
-            print(f"[Processing] Client: {client_name}")
-            client_data = extract_client_info(client_name, content, client, existing_structure)
-            if client_data:
-                print(f"   [Saving] Files for {client_name}...")
-                save_client_info(base_dir, client_name, client_data)
+        # Products only mentioned in passing are dropped before their knowledge and reference
+        # passes start. The --combined call has already covered every product, so it isn't checked.
+        if combined is None:
+            substantial = []
+            for product in products:
+                if _is_insufficient(product, doc_data):
+                    print(f"   [SKIP] {product} - only mentioned in passing, not asking the model\n")
+                else:
+                    substantial.append(product)
+            products = substantial
+
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, 2 * len(products) + 1)) as executor:
+            # Without a combined result, start the individual extraction passes concurrently
+            product_futures = {}
+            client_future = None
+            if combined is None:
+                product_futures = gather_products(executor, products, doc_data, client, input_dir)
+                # The client pass reads the digest when the sample had no client details
+                if has_client and (fused is None or not fused.client):
+                    client_future = executor.submit(
+                        contextvars.copy_context().run,
+                        extract_client_info, client_name, content, client, structure_summary)
+
+            # Process each product (saving stays sequential)
+            for product in products:
+                print(f"[Processing] Product: {product}")
+
+                # Extract product knowledge
+                if combined is not None:
+                    product_result = combined.products.get(product) or ProductExtraction(knowledge="INSUFFICIENT_INFORMATION")
+                    knowledge = product_result.knowledge
+                else:
+                    knowledge = product_futures[product][0].result()
+
+                # Check if there's sufficient information
+                if knowledge and "INSUFFICIENT_INFORMATION" in knowledge:
+                    if combined is None:
+                        # Drop the reference materials pass if it hasn't started yet
+                        product_futures[product][1].cancel()
+                    print(f"   [SKIP] {product} - insufficient information in document\n")
+                    continue
+
+                # Extract reference materials (guides, templates, procedures, etc.)
+                if combined is not None:
+                    reference_materials = product_result.reference_materials
+                else:
+                    reference_materials = product_futures[product][1].result()
+
+                # Save everything with document metadata
+                print(f"   [Saving] Files for {product}...")
+                with _get_save_lock("product", product):
+                    save_product_knowledge(base_dir, product, knowledge, reference_materials, doc_type, doc_category,
+                                           doc_metadata, date_str)
+
+            # Extract and save client information
+            if has_client:
+                print(f"[Processing] Client: {client_name}")
+                if combined is not None:
+                    client_data = combined.client
+                elif client_future is None:
+                    client_data = fused.client
+                else:
+                    client_data = client_future.result()
+                if client_data:
+                    print(f"   [Saving] Files for {client_name}...")
+                    with _get_save_lock("client", client_name):
+                        save_client_info(base_dir, client_name, client_data, date_str)
 
         print(f"\n[SUCCESS] Completed: {Path(doc_path).name}")
         return True
@@ -1312,11 +3390,186 @@ def process_document(doc_path: str, base_dir: Path, input_dir: str, client: Open
         traceback.print_exc()
         return False
 
+    finally:
+        flush_manifests()
+
+
+def merge_documents(docs: List[dict]) -> dict:
+    """Merge several extracted documents into one document for the retrieval tools
+
+    Each source document is introduced by a level 1 "[Document] <title>" section
+    holding its introduction, followed by its own sections renumbered to follow on.
+
+    Args:
+        docs: Document data returned by extract_document_structure
+
+    Returns:
+        Document data in the same shape, with the metadata of the most recently modified document
+    """
+    structure = []
+    sections = {}
+    index = 0
+
+    for doc in docs:
+        index += 1
+        offset = index
+        title = doc["metadata"].get("title") or "Untitled"
+        heading = f"[Document] {title}"
+        structure.append({"index": offset, "heading": heading, "level": 1})
+        intro = doc["sections"].get(0)
+        if intro:
+            sections[offset] = {"heading": heading, "level": 1, "content": intro["content"]}
+
+        for item in doc["structure"]:
+            structure.append({**item, "index": offset + item["index"]})
+            index = max(index, offset + item["index"])
+        for section_index, section in doc["sections"].items():
+            if section_index:
+                sections[offset + section_index] = section
+
+    newest = max(docs, key=lambda doc: doc["metadata"].get("modified") or "")
+    return {
+        "structure": structure,
+        "sections": sections,
+        "metadata": newest["metadata"],
+        "fingerprint": hashlib.sha256("".join(doc["fingerprint"] for doc in docs).encode()).hexdigest(),
+        "_soa": build_section_arrays(structure, sections)
+    }
+
+
+def process_document_group(doc_paths: List[Path], base_dir: Path, input_dir: str, client: OpenAI,
+                           workers: int, batch_mode: bool = False) -> int:
+    """Process documents together, extracting each product and client once
+
+    A cheap metadata pass runs over every document first to find out which
+    documents mention which products and clients. Each product is then extracted
+    once from the merged documents that mention it, and each client once from
+    their combined digests, instead of once per document.
+
+    Args:
+        doc_paths: Documents to process
+        base_dir: Knowledge base output directory
+        input_dir: Knowledge base directory scanned for the existing structure
+        client: OpenAI client
+        workers: Number of parallel workers
+        batch_mode: Run the metadata pass as one Batch API job (see extract_metadata_batch)
+
+    Returns:
+        Number of documents that were read and analyzed successfully
+    """
+    date_str = datetime.datetime.now().strftime('%Y-%m-%d')
+    structure_summary = summarize_existing_structure(input_dir)
+    known_names = known_entity_names(input_dir)
+    known_products = known_product_names(input_dir)
+
+    def read(doc_path: Path):
+        try:
+            doc_data = extract_document_structure(str(doc_path))
+            return doc_data, skim_document(doc_data)
+        except Exception as e:
+            print(f"[ERROR] Error reading document {doc_path.name}: {e}")
+            return None
+
+    def analyze(doc_path: Path):
+        result = read(doc_path)
+        if result is None:
+            return None
+        doc_data, content = result
+        return doc_data, content, extract_metadata(build_metadata_sample(doc_data), client, structure_summary,
+                                                   known_names, known_products)
+
+    def analyze_all() -> tuple:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            if batch_mode:
+                read_docs = [result for result in executor.map(read, doc_paths) if result is not None]
+                metadata = extract_metadata_batch([build_metadata_sample(doc_data) for doc_data, _ in read_docs],
+                                                  client, structure_summary, known_names, known_products)
+                analyzed = [(doc_data, content, meta) for (doc_data, content), meta in zip(read_docs, metadata)]
+            else:
+                analyzed = [result for result in executor.map(analyze, doc_paths) if result is not None]
+
+        # Group documents by the products and clients they mention. Only the groups are
+        # kept: documents naming neither are released on return, and the rest as their
+        # products and clients are processed.
+        product_docs: Dict[str, list] = {}
+        client_docs: Dict[str, list] = {}
+        for doc_data, content, metadata in analyzed:
+            for product in metadata.products:
+                product_docs.setdefault(product, []).append((doc_data, metadata))
+            client_name = metadata.client_name
+            if client_name and client_name.lower() not in ['none', 'unknown', 'n/a']:
+                client_docs.setdefault(client_name, []).append(content)
+        return len(analyzed), product_docs, client_docs
+
+    print(f"[Group] Analyzing {len(doc_paths)} document(s)...\n")
+    analyzed_count, product_docs, client_docs = analyze_all()
+
+    print(f"[Group] {len(product_docs)} product(s), {len(client_docs)} client(s) across {analyzed_count} document(s)")
+    for product in product_docs:
+        print(f"   {product}: {len(product_docs[product])} document(s)")
+    for client_name in client_docs:
+        print(f"   {client_name}: {len(client_docs[client_name])} document(s)")
+    print()
+
+    def process_product(product: str):
+        entries = product_docs.pop(product)
+        doc_data = merge_documents([doc for doc, _ in entries])
+        doc_type = entries[0][1].document_type
+        doc_category = entries[0][1].document_category
+
+        print(f"[Processing] Product: {product}")
+        product_structure = product_existing_structure(input_dir, product)
+        knowledge = extract_product_knowledge(product, doc_data, client, product_structure)
+        if knowledge and "INSUFFICIENT_INFORMATION" in knowledge:
+            print(f"   [SKIP] {product} - insufficient information in documents\n")
+            return
+        reference_materials = extract_document_template(product, doc_data, client, product_structure)
+
+        print(f"   [Saving] Files for {product}...")
+        with _get_save_lock("product", product):
+            save_product_knowledge(base_dir, product, knowledge, reference_materials, doc_type, doc_category,
+                                   doc_data["metadata"], date_str)
+
+    def process_client(client_name: str):
+        print(f"[Processing] Client: {client_name}")
+        content = share_budget(client_docs.pop(client_name), CLIENT_CONTENT_CHARS)
+        client_data = extract_client_info(client_name, content, client, structure_summary)
+        if client_data:
+            print(f"   [Saving] Files for {client_name}...")
+            with _get_save_lock("client", client_name):
+                save_client_info(base_dir, client_name, client_data, date_str)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_product, product) for product in list(product_docs)]
+        futures += [executor.submit(process_client, client_name) for client_name in list(client_docs)]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"\n[ERROR] Failed to process group item: {e}")
+                import traceback
+                traceback.print_exc()
+
+    flush_manifests()
+    return analyzed_count
+
 
 # ============================================================================
 # Main Function
 # ============================================================================
 
+def setup_logging(quiet: bool = False):
+    """Set how much the extractors and retrieval tools report
+
+    Only their messages go through log; the per-document progress lines are
+    printed and still shown when quiet.
+
+    Args:
+        quiet: Only show the extractors' and tools' warnings and errors
+    """
+    log.setLevel(logging.WARNING if quiet else logging.INFO)
+
+
 def main():
     """Main entry point"""
     parser = argparse.ArgumentParser(
@@ -1333,6 +3586,18 @@ Examples:
   # Process all documents recursively
   python knowledge_base_builder_kimi.py -d ./documents -r -o knowledge_base
 
+  # Process all documents with 8 parallel workers
+  python knowledge_base_builder_kimi.py -d ./documents -w 8 -o knowledge_base
+
+  # Extract each product/client once across all documents that mention it
+  python knowledge_base_builder_kimi.py -d ./documents -g -o knowledge_base
+
+  # Same, with the metadata pass run as a cheaper (but slower) Batch API job
+  python knowledge_base_builder_kimi.py -d ./documents -g --batch-mode -o knowledge_base
+
+  # Use the fast model everywhere (escalating weak results to the smart model)
+  python knowledge_base_builder_kimi.py -d ./documents --quality fast -o knowledge_base
+
   # Process a specific document by number from directory listing
   python knowledge_base_builder_kimi.py -d ./documents -o knowledge_base
   (then enter the document number when prompted)
@@ -1358,18 +3623,60 @@ Examples:
         default='knowledge_base',
         help='Output directory for knowledge base (default: knowledge_base)'
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=min(os.cpu_count() or 1, 4),
+        help='Number of documents to process in parallel in directory mode (default: min(CPU count, 4))'
+    )
+    parser.add_argument(
+        '-g', '--group',
+        action='store_true',
+        help='Directory mode: extract each product/client once from all documents that mention it'
+    )
+    parser.add_argument(
+        '--batch-mode',
+        action='store_true',
+        help='Group mode: run the metadata pass through the Batch API (cheaper, but may take hours)'
+    )
+    parser.add_argument(
+        '--combined',
+        action='store_true',
+        help='Per-document mode: extract everything in one heavy-model call per document '
+             '(fewer requests, but skips the cheaper metadata-first passes)'
+    )
+    parser.add_argument(
+        '-q', '--quiet',
+        action='store_true',
+        help='Hide the progress messages of the extractors and retrieval tools, keeping their errors '
+             '(per-document progress is still printed)'
+    )
+    parser.add_argument(
+        '--quality',
+        choices=list(QUALITY_TIERS),
+        default='balanced',
+        help='Model tier: fast (fast model everywhere), balanced (default), high (smart/best models everywhere)'
+    )
 
     args = parser.parse_args()
 
     # Validate arguments
     if not args.document and not args.dir:
         parser.error("Either provide a document path or use --dir to process a directory")
+    if args.batch_mode and not args.group:
+        parser.error("--batch-mode requires --group")
+    if args.combined and args.group:
+        parser.error("--combined can't be used with --group")
+
+    set_quality(args.quality)
+    setup_logging(args.quiet)
 
     # Debug: Show environment variables
     print("\n[DEBUG] Environment Configuration:")
     print(f"  MOONSHOT_API_KEY: {'SET (' + MOONSHOT_API_KEY[:8] + '...' + MOONSHOT_API_KEY[-4:] + ')' if MOONSHOT_API_KEY else 'NOT SET'}")
     print(f"  MOONSHOT_BASE_URL: {MOONSHOT_BASE_URL}")
     print(f"  API Key Length: {len(MOONSHOT_API_KEY) if MOONSHOT_API_KEY else 0} characters")
+    print(f"  Quality: {args.quality} (light: {ACTIVE_MODELS['light']}, heavy: {ACTIVE_MODELS['heavy']})")
     print()
 
     # Validate API key
@@ -1380,19 +3687,16 @@ Examples:
         return 1
 
     # Initialize OpenAI client for Moonshot API
-    client = OpenAI(
-        api_key=MOONSHOT_API_KEY,
-        base_url=MOONSHOT_BASE_URL
-    )
+    client = get_client(MOONSHOT_API_KEY, MOONSHOT_BASE_URL)
 
-    # Test API connection
+    # Test API connection, retrying transient failures like every other request
     try:
         print("[Initializing] Testing Moonshot API connection...")
-        client.chat.completions.create(
-            model=MODEL_FAST,
-            messages=[{"role": "user", "content": "Hello"}],
-            max_tokens=10
-        )
+        create_completion(client, {
+            "model": MODEL_FAST,
+            "messages": [{"role": "user", "content": "Hello"}],
+            "max_tokens": 10
+        })
         print("[OK] Moonshot API connection successful\n")
     except Exception as e:
         print(f"[ERROR] Failed to connect to Moonshot API: {e}")
@@ -1427,7 +3731,7 @@ Examples:
             if 1 <= doc_num <= len(docx_files):
                 selected_doc_index = doc_num - 1
                 print(f"[OK] Processing only document #{doc_num}: {docx_files[selected_doc_index].name}\n")
-                success = process_document(str(docx_files[selected_doc_index]), base_dir, args.output, client)
+                success = process_document(str(docx_files[selected_doc_index]), base_dir, args.output, client, args.combined)
                 if success:
                     print(f"\n[COMPLETE] Successfully processed 1 document")
                     print(f"[KB] Knowledge base location: {base_dir.absolute()}")
@@ -1444,21 +3748,46 @@ Examples:
             for doc_file in docx_files:
                 confirm = input(f"\nProcess {doc_file.name}? (y/n): ").strip().lower()
                 if confirm == 'y':
-                    success = process_document(str(doc_file), base_dir, args.output, client)
+                    success = process_document(str(doc_file), base_dir, args.output, client, args.combined)
                     if success:
                         processed += 1
             print(f"\n[COMPLETE] Successfully processed {processed}/{len(docx_files)} documents")
             print(f"[KB] Knowledge base location: {base_dir.absolute()}")
+            print_retry_summary()
+        elif args.group:
+            # Process all together - one extraction per product/client across documents
+            workers = max(1, min(args.workers, len(docx_files)))
+            print(f"[OK] Processing as a group with {workers} worker(s)\n")
+            processed = process_document_group(docx_files, base_dir, args.output, client, workers, args.batch_mode)
+
+            print(f"\n[COMPLETE] Successfully processed {processed}/{len(docx_files)} documents")
+            print(f"[KB] Knowledge base location: {base_dir.absolute()}")
+            print_retry_summary()
         else:
-            # Process all
+            # Process all - documents are independent, so run them on a worker pool
             processed = 0
-            for doc_file in docx_files:
-                success = process_document(str(doc_file), base_dir, args.output, client)
-                if success:
-                    processed += 1
+            workers = max(1, min(args.workers, len(docx_files)))
+            print(f"[OK] Processing with {workers} worker(s)\n")
+
+            def process_buffered(doc_file: Path) -> bool:
+                # With several workers, print each document's output as one block when it finishes
+                if workers == 1:
+                    return process_document(str(doc_file), base_dir, args.output, client, args.combined)
+                with buffer_document_output():
+                    return process_document(str(doc_file), base_dir, args.output, client, args.combined)
+
+            capture = capture_document_output() if workers > 1 else contextlib.nullcontext()
+            with capture, ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(process_buffered, doc_file): doc_file for doc_file in docx_files}
+                # Report documents as they finish rather than in submission order
+                for done, future in enumerate(as_completed(futures), 1):
+                    if future.result():
+                        processed += 1
+                    print(f"[Progress] {done}/{len(docx_files)} documents finished ({futures[future].name})")
 
             print(f"\n[COMPLETE] Successfully processed {processed}/{len(docx_files)} documents")
             print(f"[KB] Knowledge base location: {base_dir.absolute()}")
+            print_retry_summary()
 
     else:
         # Single document mode
@@ -1467,7 +3796,7 @@ Examples:
             print(f"[ERROR] Document not found: {doc_path}")
             return 1
 
-        success = process_document(doc_path, base_dir, args.output, client)
+        success = process_document(doc_path, base_dir, args.output, client, args.combined)
         if success:
             print(f"\n[COMPLETE] Successfully processed document")
             print(f"[KB] Knowledge base location: {base_dir.absolute()}")
@@ -0,0 +1,76 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import knowledge_base_builder_kimi as kb
+
+
+@pytest.fixture
+def sample_docx(tmp_path):
+    """A small Word document: an introduction, a product overview with a table, and three subsections"""
+    docx = pytest.importorskip("docx")
+    document = docx.Document()
+    document.add_paragraph("Intro text for the Roy Hill site about the BULKmetrix system.")
+    document.add_heading("BULKmetrix Overview", 1)
+    document.add_paragraph("BULKmetrix is a software platform for measuring bulk material flow on conveyors. " * 5)
+    document.add_paragraph("Page 3")
+    document.add_paragraph("Filler sentence that carries no names at all, just words here.")
+    document.add_paragraph("The client Roy Hill runs it on the Pilbara site.")
+    table = document.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Port"
+    table.cell(0, 1).text = "502"
+    document.add_heading("Configuration", 2)
+    document.add_paragraph("Configure BULKmetrix by editing the config file and restarting the service.")
+    document.add_heading("Installation Steps", 2)
+    document.add_paragraph("Install BULKmetrix on the Windows server using the MSI installer package.")
+    document.add_heading("Installation Notes", 2)
+    document.add_paragraph("Installation needs administrator rights on the target server.")
+    path = tmp_path / "sample.docx"
+    document.save(path)
+    return path
+
+
+@pytest.fixture
+def doc_data(sample_docx, monkeypatch):
+    monkeypatch.setattr(kb, "LLM_CACHE_DIR", None)
+    return kb.extract_document_structure(str(sample_docx))
+
+
+@pytest.fixture
+def current_document(doc_data):
+    """Load doc_data for the retrieval tools, as extract_product_knowledge does"""
+    token = kb._current_document.set(doc_data)
+    yield doc_data
+    kb._current_document.reset(token)
+
+
+class StubClient:
+    """Stands in for the OpenAI client, answering chat completions from a list of replies
+
+    Each reply is the message content to return, or an exception to raise.
+    The keyword arguments of every request are kept in requests.
+    """
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.requests.append(kwargs)
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        message = SimpleNamespace(content=reply, tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message, finish_reason="stop")])
+
+
+@pytest.fixture
+def stub_client(monkeypatch):
+    """StubClient, with the response cache turned off"""
+    monkeypatch.setattr(kb, "LLM_CACHE_DIR", None)
+    return StubClient
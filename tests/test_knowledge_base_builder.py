@@ -0,0 +1,495 @@
+import json
+import os
+from types import SimpleNamespace
+
+import msgspec
+import pytest
+from lxml import etree
+
+import knowledge_base_builder_kimi as kb
+
+
+def test_skim_document_keeps_headings_tables_and_long_lines(doc_data):
+    digest = kb.skim_document(doc_data)
+
+    assert digest.startswith("Intro text for the Roy Hill site")
+    assert "\n# BULKmetrix Overview\n" in digest
+    assert "\n## Installation Notes\n" in digest
+    assert "The client Roy Hill runs it on the Pilbara site." in digest
+    assert "[TABLE]\nPort | 502\n[/TABLE]" in digest
+    # Lines shorter than SKIM_MIN_LINE_CHARS are page furniture
+    assert "Page 3" not in digest
+
+
+def test_skim_document_respects_limit(doc_data):
+    digest = kb.skim_document(doc_data, limit=100)
+
+    assert len(digest) == 100
+    assert kb.skim_document(doc_data).startswith(digest)
+
+
+def test_get_section_by_heading_prefix_match(current_document):
+    assert kb.get_section_by_heading("config") == (
+        "# Configuration\n\nConfigure BULKmetrix by editing the config file and restarting the service."
+    )
+
+
+def test_get_section_by_heading_prefix_lists_multiple_matches(current_document):
+    result = kb.get_section_by_heading("Installation")
+
+    assert result.startswith("Multiple sections found matching 'Installation':")
+    assert "  3. Installation Steps\n  4. Installation Notes" in result
+
+
+def test_get_section_by_heading_falls_back_to_substring(current_document):
+    assert kb.get_section_by_heading("steps").startswith("# Installation Steps\n\nInstall BULKmetrix")
+    assert kb.get_section_by_heading("metrix overview").startswith("# BULKmetrix Overview\n\n")
+
+
+def test_get_section_by_heading_no_match(current_document):
+    assert kb.get_section_by_heading("licensing") == "Error: No sections found matching 'licensing'"
+
+
+def test_get_section_by_heading_without_document():
+    assert kb.get_section_by_heading("config") == "Error: No document is currently loaded"
+
+
+def test_build_metadata_sample_keeps_section_starts_and_named_keyword_lines(doc_data):
+    sample = kb.build_metadata_sample(doc_data)
+
+    assert "# BULKmetrix Overview\nBULKmetrix is a software platform" in sample
+    # Past METADATA_SECTION_CHARS, only lines naming something next to a keyword are kept
+    assert "The client Roy Hill runs it on the Pilbara site." in sample
+    assert "Filler sentence" not in sample
+    assert "[TABLE]" not in sample
+    assert "## Configuration\nConfigure BULKmetrix" in sample
+
+
+def test_build_metadata_sample_respects_limit(doc_data):
+    assert len(kb.build_metadata_sample(doc_data, limit=50)) == 50
+
+
+@pytest.fixture
+def manifests(monkeypatch):
+    monkeypatch.setattr(kb, "_manifests", {})
+    monkeypatch.setattr(kb, "_dirty_manifests", {})
+
+
+def test_write_files_manifest_persists_across_runs(tmp_path, manifests, monkeypatch):
+    a = tmp_path / "Products" / "A" / "overview.md"
+    kb.write_files(tmp_path, [(a, "alpha")])
+    kb.flush_manifests()
+
+    manifest = json.loads((tmp_path / kb.MANIFEST_NAME).read_text(encoding="utf-8"))
+    assert list(manifest) == ["Products/A/overview.md"]
+
+    # A new run loads the manifest from disk
+    monkeypatch.setattr(kb, "_manifests", {})
+    assert not kb.write_files(tmp_path, [(a, "alpha")])
+
+
+@pytest.fixture
+def overview(tmp_path):
+    path = tmp_path / "overview.md"
+    path.write_text('---\nsource_document_modified: "2024-05-01T00:00:00+00:00"\n---\n\n# Product\n',
+                    encoding="utf-8")
+    return path
+
+
+def test_is_up_to_date_reads_front_matter(overview):
+    assert kb._is_up_to_date(overview, "2024-04-01T00:00:00+00:00")
+    assert kb._is_up_to_date(overview, "2024-05-01T00:00:00+00:00")
+    assert not kb._is_up_to_date(overview, "2024-06-01T00:00:00+00:00")
+
+
+def test_is_up_to_date_skips_articles_written_before_the_source(overview):
+    # An article written before the source was modified can't record it, whatever its front matter says
+    os.utime(overview, (0, 0))
+    assert not kb._is_up_to_date(overview, "2024-04-01T00:00:00+00:00")
+
+
+@pytest.fixture
+def structure_cache(monkeypatch):
+    cache = {"key": None, "data": None, "generation": 0}
+    monkeypatch.setattr(kb, "_structure_cache", cache)
+    return cache
+
+
+def _touch(path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("", encoding="utf-8")
+    return path
+
+
+def test_record_structure_writes_updates_cached_scan(tmp_path, structure_cache):
+    _touch(tmp_path / "Products" / "Alpha" / "overview.md")
+    _touch(tmp_path / "Clients" / "Roy Hill" / "overview.md")
+    kb._scan_structure(str(tmp_path))
+
+    written = [
+        _touch(tmp_path / "Products" / "Beta" / "overview.md"),
+        _touch(tmp_path / "Products" / "Alpha" / "Reference Materials" / "Setup" / "Guide.md"),
+        _touch(tmp_path / "Clients" / "Roy Hill" / "contacts.md"),
+        _touch(tmp_path / "Clients" / "Acme" / "overview.md"),
+    ]
+    kb.record_structure_writes(tmp_path, written)
+
+    expected = {
+        "products": {"Alpha": ["Setup"], "Beta": []},
+        "clients": {"Acme": ["overview.md"], "Roy Hill": ["contacts.md", "overview.md"]},
+    }
+    assert structure_cache["data"] == expected
+    # The updated scan is served from the cache, and matches a fresh scan
+    assert kb._scan_structure(str(tmp_path)) is structure_cache["data"]
+    structure_cache["key"] = None
+    assert kb._scan_structure(str(tmp_path)) == expected
+
+
+def test_record_structure_writes_invalidates_other_knowledge_bases(tmp_path, structure_cache):
+    _touch(tmp_path / "kb" / "Products" / "Alpha" / "overview.md")
+    kb._scan_structure(str(tmp_path / "kb"))
+    generation = structure_cache["generation"]
+
+    other = tmp_path / "other"
+    kb.record_structure_writes(other, [_touch(other / "Products" / "Beta" / "overview.md")])
+
+    assert structure_cache["key"] is None
+    assert structure_cache["data"] is None
+    assert structure_cache["generation"] > generation
+
+
+def test_write_files_skips_unchanged_content(tmp_path, manifests):
+    a = tmp_path / "Products" / "A" / "overview.md"
+    b = tmp_path / "Clients" / "B" / "overview.md"
+
+    assert kb.write_files(tmp_path, [(a, "alpha"), (b, "beta")]) == [a, b]
+    assert a.read_text(encoding="utf-8") == "alpha"
+    assert kb.write_files(tmp_path, [(a, "alpha"), (b, "beta")]) == []
+    assert kb.write_files(tmp_path, iter([(a, "alpha"), (b, "beta 2")])) == [b]
+    assert b.read_text(encoding="utf-8") == "beta 2"
+
+
+def test_write_files_rewrites_deleted_files(tmp_path, manifests):
+    a = tmp_path / "overview.md"
+    kb.write_files(tmp_path, [(a, "alpha")])
+    a.unlink()
+
+    assert kb.write_files(tmp_path, [(a, "alpha")]) == [a]
+    assert a.exists()
+
+
+@pytest.mark.parametrize("existing, new, expected", [
+    ("2024-05-01T00:00:00+00:00", "2024-05-01T00:00:00+00:00", True),
+    ("2024-05-02T00:00:00+00:00", "2024-05-01T00:00:00+00:00", True),
+    ("2024-05-01T00:00:00+00:00", "2024-05-02T00:00:00+00:00", False),
+    # Same moment written in different time zones
+    ("2024-05-01T10:00:00+10:00", "2024-05-01T00:00:00+00:00", True),
+    # Unparseable or naive/aware mixes fall back to comparing the strings
+    ("unknown", "2024-05-01", True),
+    ("2024-05-01T00:00:00", "2024-05-02T00:00:00+00:00", False),
+])
+def test_is_not_older(existing, new, expected):
+    assert kb._is_not_older(existing, new) is expected
+
+
+def test_is_up_to_date_remembers_the_source_date(overview):
+    assert kb._is_up_to_date(overview, "2024-04-01T00:00:00+00:00")
+    overview.unlink()
+    assert kb._is_up_to_date(overview, "2024-04-01T00:00:00+00:00")
+
+
+def test_is_up_to_date_without_date_or_article(tmp_path, overview):
+    assert not kb._is_up_to_date(overview, "")
+    assert not kb._is_up_to_date(tmp_path / "missing.md", "2024-04-01T00:00:00+00:00")
+
+
+def test_share_budget_gives_every_text_a_share():
+    texts = ["a" * 10000, "b" * 10000, "c" * 10000, "d" * 50]
+    joined = kb.share_budget(texts, 20000)
+
+    assert len(joined) == 20000
+    # The short text is kept whole and the rest of the budget is split evenly
+    assert [part.count(part[0]) for part in joined.split("\n\n")] == [6648, 6648, 6648, 50]
+
+
+def test_share_budget_keeps_texts_that_fit():
+    assert kb.share_budget(["ab", "cd"], 100) == "ab\n\ncd"
+
+
+def test_extract_metadata_and_client_drops_null_categories(stub_client):
+    client = stub_client(json.dumps({
+        "metadata": {"products": ["BULKmetrix"], "client_name": "Roy Hill",
+                     "document_type": "Manual", "document_category": "Configuration"},
+        "client": {"overview": None, "locations": ["Pilbara"], "hardware": None},
+    }))
+
+    result = kb.extract_metadata_and_client("Roy Hill runs BULKmetrix on the SCADA network.", client, "")
+
+    assert result.client == {"locations": ["Pilbara"]}
+    assert len(client.requests) == 1
+
+
+def test_extract_document_structure_keeps_tabs_and_line_breaks(tmp_path, monkeypatch):
+    docx = pytest.importorskip("docx")
+    monkeypatch.setattr(kb, "LLM_CACHE_DIR", None)
+    document = docx.Document()
+    document.add_heading("Settings", 1)
+    document.add_paragraph("Name:\tValue")
+    run = document.add_paragraph().add_run("line1")
+    run.add_break()
+    run.add_text("line2")
+    path = tmp_path / "breaks.docx"
+    document.save(path)
+
+    sections = kb.extract_document_structure(str(path))["sections"]
+
+    assert sections[1]["content"] == "Name:\tValue\nline1\nline2"
+
+
+def test_paragraph_text_reads_runs_like_python_docx():
+    w = kb._W_NAMESPACES["w"]
+    paragraph = etree.fromstring(
+        f'<w:p xmlns:w="{w}">'
+        '<w:r><w:t>See </w:t><w:tab/><w:br w:type="page"/></w:r>'
+        '<w:hyperlink><w:r><w:t>the manual</w:t></w:r></w:hyperlink>'
+        '<w:r><w:cr/><w:t>end</w:t>'
+        '<w:drawing><w:txbxContent><w:p><w:r><w:t>text box</w:t></w:r></w:p></w:txbxContent></w:drawing></w:r>'
+        '</w:p>'
+    )
+
+    assert kb._paragraph_text(paragraph) == "See \tthe manual\nend"
+
+
+def _batch_answer(custom_id, answer):
+    return json.dumps({"custom_id": custom_id,
+                       "response": {"body": {"choices": [{"message": {"content": json.dumps(answer)}}]}}})
+
+
+def test_extract_metadata_batch_maps_answers_to_documents(stub_client):
+    client = stub_client()
+    output = "\n".join([
+        "not json",
+        _batch_answer("2", {"products": ["FLOWtrack"], "client_name": None,
+                            "document_type": "Manual", "document_category": "Operations"}),
+        _batch_answer("1", {"client_name": "Roy Hill", "document_type": "Guide",
+                            "document_category": "Configuration"}),
+    ])
+    submitted = []
+
+    def create_file(file, purpose):
+        submitted.extend(json.loads(line) for line in file[1].decode("utf-8").splitlines())
+        return SimpleNamespace(id="file-in")
+
+    client.files = SimpleNamespace(create=create_file,
+                                   content=lambda file_id: SimpleNamespace(text=output))
+    client.batches = SimpleNamespace(
+        create=lambda **kwargs: SimpleNamespace(id="batch", status="completed", output_file_id="file-out"))
+    contents = [
+        "just some filler words here",
+        "Configure BULKmetrix on the Roy Hill server.",
+        "The SCADA link to FLOWtrack.",
+    ]
+
+    results = kb.extract_metadata_batch(contents, client, "", known_names=["BULKmetrix", "Roy Hill"],
+                                        known_products=["BULKmetrix"])
+
+    assert [request["custom_id"] for request in submitted] == ["1", "2"]
+    # The document whose products are all known is only asked for its classification
+    assert submitted[0]["body"]["messages"][0]["content"] == kb._build_classification_prompt(
+        ["BULKmetrix"], contents[1], "")
+    assert results[0] == kb._default_metadata()
+    assert results[1] == kb.DocumentMetadata(products=["BULKmetrix"], client_name="Roy Hill",
+                                             document_type="Guide", document_category="Configuration")
+    assert results[2].products == ["FLOWtrack"]
+    # Every document was answered by the batch, so no individual request was made
+    assert client.requests == []
+
+
+def test_get_similar_returns_the_closest_entry_above_the_threshold(tmp_path):
+    cache = kb.SqliteLLMCache(str(tmp_path / "cache.sqlite3"))
+    cache.set_similar("scope", list(range(100)), "close")
+    cache.set_similar("scope", list(range(50, 150)), "far")
+    cache.set_similar("other", list(range(100)), "other scope")
+
+    # 98 of the 102 hashes in the union are shared with "close"
+    assert cache.get_similar("scope", list(range(98)) + [200, 201], 0.95) == "close"
+    assert cache.get_similar("scope", list(range(98)) + [200, 201], 0.99) is None
+    assert cache.get_similar("missing", list(range(100)), 0.5) is None
+
+
+def test_set_similar_keeps_the_newest_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(kb, "NEAR_DUPLICATE_MAX_ENTRIES", 2)
+    cache = kb.SqliteLLMCache(str(tmp_path / "cache.sqlite3"))
+    for n in range(3):
+        cache.set_similar("scope", [n], f"article {n}")
+    cache.set_similar("other", [0], "other scope")
+
+    assert cache.get_similar("scope", [0], 1.0) is None
+    assert cache.get_similar("scope", [2], 1.0) == "article 2"
+    assert cache.get_similar("other", [0], 1.0) == "other scope"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    monkeypatch.setattr(kb, "API_RETRY_BASE_DELAY", 1)
+    monkeypatch.setattr(kb, "API_RETRY_MAX_DELAY", 2)
+    waits = []
+    monkeypatch.setattr(kb.time, "sleep", waits.append)
+    return waits
+
+
+def test_create_completion_retries_transient_errors(stub_client, sleeps, monkeypatch):
+    monkeypatch.setattr(kb, "API_RETRY_BUDGET", 60)
+    client = stub_client(kb.APIConnectionError(request=None), TimeoutError(), TimeoutError(), "ok")
+
+    response = kb.create_completion(client, {"model": "m", "messages": []})
+
+    assert response.choices[0].message.content == "ok"
+    assert len(client.requests) == 4
+    # Each wait is drawn from the upper half of a delay that doubles up to API_RETRY_MAX_DELAY
+    assert 0.5 <= sleeps[0] <= 1
+    assert all(1 <= wait <= 2 for wait in sleeps[1:])
+
+
+def test_create_completion_gives_up_when_the_budget_is_spent(stub_client, sleeps, monkeypatch):
+    monkeypatch.setattr(kb, "API_RETRY_BUDGET", 0)
+    client = stub_client(TimeoutError("slow"), "ok")
+
+    with pytest.raises(TimeoutError):
+        kb.create_completion(client, {"model": "m", "messages": []})
+    assert len(client.requests) == 1
+    assert sleeps == []
+
+
+def test_create_completion_does_not_retry_other_errors(stub_client, sleeps):
+    client = stub_client(ValueError("bad request"), "ok")
+
+    with pytest.raises(ValueError):
+        kb.create_completion(client, {"model": "m", "messages": []})
+    assert sleeps == []
+
+
+def test_sqlite_cache_stores_and_replaces_responses(tmp_path):
+    path = str(tmp_path / "cache" / "llm_cache.sqlite3")
+    cache = kb.SqliteLLMCache(path)
+
+    assert cache.get("key") is None
+    cache.set("key", "first", "model")
+    cache.set("key", "second", "model")
+    assert cache.get("key") == "second"
+    # A new connection (the next run) sees the stored response
+    assert kb.SqliteLLMCache(path).get("key") == "second"
+
+
+def test_run_json_extraction_reuses_cached_responses(stub_client, tmp_path, monkeypatch):
+    monkeypatch.setattr(kb, "LLM_CACHE_DIR", str(tmp_path))
+    kb._get_llm_cache.cache_clear()
+    client = stub_client('{"client_name": "Roy Hill", "document_type": "Guide", "document_category": "Setup"}')
+
+    try:
+        first = kb.run_json_extraction(client, "model", "prompt", kb.DocumentClassification)
+        second = kb.run_json_extraction(client, "model", "prompt", kb.DocumentClassification)
+    finally:
+        kb._get_llm_cache.cache_clear()
+
+    assert first == second
+    assert first.client_name == "Roy Hill"
+    assert len(client.requests) == 1
+
+
+@pytest.mark.parametrize("content", [
+    '{"a": 1}',
+    '```json\n{"a": 1}\n```',
+    '```\n{"a": 1}\n```',
+    '```json{"a": 1}```',
+    # Truncated responses may lose the closing fence
+    '```json\n{"a": 1}\n',
+    'Here is the result:\n```json\n{"a": 1}\n```\nLet me know if you need more.',
+    'Here is the result: {"a": 1}',
+])
+def test_parse_json_response_finds_the_json(content):
+    assert kb.parse_json_response(content) == {"a": 1}
+
+
+def test_parse_json_response_leaves_fences_inside_bare_json():
+    assert kb.parse_json_response('{"a": "```json\\n{}\\n```"}') == {"a": "```json\n{}\n```"}
+
+
+def test_parse_json_response_validates_the_result_type():
+    metadata = kb.parse_json_response(
+        '```json\n{"products": [], "client_name": null, "document_type": "Unknown", '
+        '"document_category": "General"}\n```',
+        kb.DocumentMetadata
+    )
+    assert metadata == kb._default_metadata()
+    with pytest.raises(msgspec.ValidationError):
+        kb.parse_json_response('{"products": "BULKmetrix"}', kb.DocumentMetadata)
+
+
+@pytest.mark.parametrize("content", ["", "No JSON here"])
+def test_parse_json_response_without_json(content):
+    with pytest.raises(json.JSONDecodeError):
+        kb.parse_json_response(content)
+
+
+def test_is_insufficient_for_products_mentioned_in_passing(doc_data):
+    # Named in a heading
+    assert not kb._is_insufficient("bulkMETRIX", doc_data)
+    # Named once in the body
+    assert kb._is_insufficient("Pilbara", doc_data)
+    assert kb._is_insufficient("FLOWtrack", doc_data)
+
+
+def test_is_insufficient_counts_mentions_across_sections(monkeypatch):
+    monkeypatch.setattr(kb, "MIN_PRODUCT_MENTIONS", 3)
+
+    def doc(*contents):
+        return {"_soa": {"headings_lc": ["introduction", "setup"], "contents": list(contents)}}
+
+    assert kb._is_insufficient("QMS", doc("QMS and QMS", None))
+    assert not kb._is_insufficient("QMS", doc("QMS and QMS", "Open qms"))
+
+
+@pytest.mark.parametrize("text, expected", [
+    # A known name, whatever its case
+    ("Notes on the Pilbara conveyors", True),
+    # Acronyms, but not the [TABLE] markers the parser adds
+    ("Restart the PLC after changes", True),
+    ("[TABLE]\nport | value\n[/TABLE]", False),
+    # Capitalized multi-word phrases: two are not enough, three are
+    ("Meeting with Jane Smith about Project Apollo", False),
+    ("Meeting with Jane Smith about Project Apollo at Port Hedland", True),
+    ("please restart the service after editing the file", False),
+])
+def test_has_likely_entities(text, expected, monkeypatch):
+    monkeypatch.setattr(kb, "MIN_NAME_PHRASES", 3)
+    assert kb.has_likely_entities(text, ["pilbara"]) is expected
+
+
+def test_spot_known_products_keeps_technical_or_repeated_mentions(monkeypatch):
+    monkeypatch.setattr(kb, "LEXICON_MIN_HITS", 3)
+    known = ["BULKmetrix", "Insight CM", "Belt Monitor"]
+    text = "\n".join([
+        "Our sites use Insight CM daily.",
+        "Insight CM reports trends.",
+        "To configure bulkmetrix, edit the settings file.",
+        "Insight CM alerts the operators.",
+        "The Belt Monitor is listed for reference.",
+    ])
+
+    # Names come back as the knowledge base spells them, in order of first mention
+    assert kb.spot_known_products(text, known) == ["Insight CM", "BULKmetrix"]
+
+
+def test_spot_known_products_prefers_the_longest_name():
+    assert kb.spot_known_products("Install QMS Cloud on the server.", ["QMS", "QMS Cloud"]) == ["QMS Cloud"]
+
+
+def test_spot_known_products_defers_to_the_model():
+    known = ["BULKmetrix"]
+    # No known products, or none discussed
+    assert kb.spot_known_products("Configure BULKmetrix.", []) is None
+    assert kb.spot_known_products("BULKmetrix is mentioned once.", known) is None
+    # An acronym outside the known names may be a new product
+    assert kb.spot_known_products("Configure BULKmetrix with SCADA.", known) is None
+    assert kb.spot_known_products("Configure BULKmetrix with SCADA.", known, ["SCADA"]) == ["BULKmetrix"]